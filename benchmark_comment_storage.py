@@ -0,0 +1,136 @@
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+from telegram_bot import migrate_comment_post_references
+
+# Size of the generated dataset
+CHANNELS = 20
+POSTS_PER_CHANNEL = 250
+
+# Post and comment lengths in characters, roughly what news channels produce
+POST_LENGTH = (300, 2000)
+COMMENT_LENGTH = (20, 200)
+
+# Comments per post follow a long tail: most posts get a few, some get hundreds
+COMMENTS_PARETO_ALPHA = 1.3
+MAX_COMMENTS_PER_POST = 500
+
+SCHEMA = '''
+CREATE TABLE posts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    date TEXT,
+    channel_name TEXT,
+    content TEXT,
+    message_id INTEGER
+);
+CREATE UNIQUE INDEX idx_posts_channel_message ON posts (channel_name, message_id);
+CREATE TABLE comments (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    date TEXT,
+    channel_name TEXT,
+    post_content TEXT,
+    comment_text TEXT,
+    user_id INTEGER,
+    username TEXT,
+    sentiment TEXT,
+    message_id INTEGER,
+    post_message_id INTEGER
+);
+CREATE INDEX idx_comments_channel_post ON comments (channel_name, post_message_id);
+'''
+
+EXPORT_QUERY = '''
+SELECT c.date, c.channel_name, COALESCE(p.content, c.post_content), c.comment_text, c.user_id, c.username, c.sentiment
+FROM comments c LEFT JOIN posts p ON p.channel_name = c.channel_name AND p.message_id = c.post_message_id
+'''
+
+WORDS = ("новости канал сегодня заявил power market update report city people government price "
+         "команда матч время данные продажи рост цены week year").split()
+
+def make_text(rng, length_range):
+    """Generate text of a random length within the range"""
+    length = rng.randint(*length_range)
+    words = []
+    while sum(len(word) + 1 for word in words) < length:
+        words.append(rng.choice(WORDS))
+    return " ".join(words)
+
+def make_dataset():
+    """Generate posts and comments with comments copying their post text and no post reference, as the old layout did"""
+    rng = random.Random(42)
+    posts = []
+    comments = []
+    comment_id = 0
+
+    for channel in range(CHANNELS):
+        channel_name = f"channel_{channel}"
+        for message_id in range(1, POSTS_PER_CHANNEL + 1):
+            content = make_text(rng, POST_LENGTH)
+            posts.append(("2024-01-01 12:00:00", channel_name, content, message_id))
+
+            count = min(int(rng.paretovariate(COMMENTS_PARETO_ALPHA)) - 1, MAX_COMMENTS_PER_POST)
+            for _ in range(count):
+                comment_id += 1
+                comments.append((
+                    "2024-01-01 12:30:00", channel_name, content, make_text(rng, COMMENT_LENGTH),
+                    rng.randint(1, 100000), f"user_{rng.randint(1, 100000)}", "neutral", comment_id
+                ))
+
+    return posts, comments
+
+def build_database(path, posts, comments):
+    """Write the dataset in the old layout"""
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    conn.executemany("INSERT INTO posts (date, channel_name, content, message_id) VALUES (?, ?, ?, ?)", posts)
+    conn.executemany(
+        "INSERT INTO comments (date, channel_name, post_content, comment_text, user_id, username, sentiment, "
+        "message_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        comments
+    )
+    conn.commit()
+    conn.execute("VACUUM")
+    conn.close()
+
+def time_export(path):
+    """Time a full comments export query with the post text joined in"""
+    conn = sqlite3.connect(path)
+    started_at = time.perf_counter()
+    rows = conn.execute(EXPORT_QUERY).fetchall()
+    elapsed = time.perf_counter() - started_at
+    conn.close()
+    return len(rows), elapsed
+
+def main():
+    posts, comments = make_dataset()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "comments.db")
+        build_database(path, posts, comments)
+        size_before = os.path.getsize(path)
+        rows_before, export_before = time_export(path)
+
+        conn = sqlite3.connect(path)
+        started_at = time.perf_counter()
+        migrate_comment_post_references(conn.cursor())
+        conn.commit()
+        migration_time = time.perf_counter() - started_at
+        linked = conn.execute("SELECT COUNT(*) FROM comments WHERE post_message_id IS NOT NULL").fetchone()[0]
+        conn.execute("VACUUM")
+        conn.close()
+
+        size_after = os.path.getsize(path)
+        rows_after, export_after = time_export(path)
+
+    assert rows_before == rows_after
+    print(f"Dataset: {len(posts):,} posts, {len(comments):,} comments")
+    print(f"Migration: {linked:,} comments linked to their post in {migration_time:.2f}s")
+    print(f"Copied post text: {size_before / 1024 / 1024:.1f} MB, comments export {export_before:.2f}s")
+    print(f"Post referenced:  {size_after / 1024 / 1024:.1f} MB, comments export {export_after:.2f}s")
+    print(f"Size reduction: {(1 - size_after / size_before) * 100:.0f}%")
+
+if __name__ == '__main__':
+    main()
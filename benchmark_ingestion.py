@@ -0,0 +1,82 @@
+import os
+import sqlite3
+import tempfile
+import time
+
+# Number of rows written by each run
+ROWS = 20000
+
+# Rows per executemany batch in the batched run (roughly one source per cycle)
+BATCH_SIZE = 500
+
+SCHEMA = '''
+CREATE TABLE posts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    date TEXT,
+    channel_name TEXT,
+    content TEXT,
+    message_id INTEGER
+);
+CREATE UNIQUE INDEX idx_posts_channel_message ON posts (channel_name, message_id);
+'''
+
+def make_rows():
+    """Generate posts spread over a few channels"""
+    return [
+        ("2024-01-01 12:00:00", f"channel_{i % 50}", f"Post number {i} " * 10, i)
+        for i in range(ROWS)
+    ]
+
+def run_row_by_row(path, rows):
+    """Old write path: rollback journal, default sync, one commit per row"""
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    cursor = conn.cursor()
+
+    started_at = time.perf_counter()
+    for row in rows:
+        cursor.execute(
+            "INSERT OR IGNORE INTO posts (date, channel_name, content, message_id) VALUES (?, ?, ?, ?)",
+            row
+        )
+        conn.commit()
+    elapsed = time.perf_counter() - started_at
+
+    conn.close()
+    return elapsed
+
+def run_batched(path, rows):
+    """New write path: WAL, synchronous=NORMAL, executemany with one commit per batch"""
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA cache_size = -64000")
+    conn.executescript(SCHEMA)
+    cursor = conn.cursor()
+
+    started_at = time.perf_counter()
+    for i in range(0, len(rows), BATCH_SIZE):
+        cursor.executemany(
+            "INSERT INTO posts (date, channel_name, content, message_id) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(channel_name, message_id) DO UPDATE SET content = excluded.content",
+            rows[i:i + BATCH_SIZE]
+        )
+        conn.commit()
+    elapsed = time.perf_counter() - started_at
+
+    conn.close()
+    return elapsed
+
+def main():
+    rows = make_rows()
+
+    with tempfile.TemporaryDirectory() as directory:
+        before = run_row_by_row(os.path.join(directory, "before.db"), rows)
+        after = run_batched(os.path.join(directory, "after.db"), rows)
+
+    print(f"Row-by-row commits: {ROWS / before:,.0f} rows/sec ({before:.2f}s)")
+    print(f"Batched WAL writes: {ROWS / after:,.0f} rows/sec ({after:.2f}s)")
+    print(f"Speedup: {before / after:.1f}x")
+
+if __name__ == '__main__':
+    main()
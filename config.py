@@ -1,3 +1,7 @@
 api_id = 'ваш_api_id'  
 api_hash = 'ваш_api_hash'  
-BOT_TOKEN = 'токен_вашего_бота'  
\ No newline at end of file
+BOT_TOKEN = 'токен_вашего_бота'  
+# Дополнительные аккаунты Telegram для распределения источников (необязательно)
+# ACCOUNTS = [
+#     {"session": "account_2", "api_id": 'api_id_2', "api_hash": 'api_hash_2'},
+# ]
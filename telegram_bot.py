@@ -1,28 +1,54 @@
 import asyncio
+import bisect
 import datetime
+import functools
+import hashlib
+import heapq
+from collections import OrderedDict, deque
 import json
 import logging
+import math
+import multiprocessing
 import os
 import re
 import sqlite3
-from datetime import datetime, timedelta
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 import matplotlib.pyplot as plt
 import numpy as np
 import openpyxl
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import Font, Alignment, PatternFill
-from aiogram import Bot, Dispatcher, types
+from openpyxl.utils import get_column_letter
+from aiogram import Bot, Dispatcher, executor, types
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.types import ParseMode, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
-from telethon import TelegramClient
-from telethon.tl.functions.channels import JoinChannelRequest
-from telethon.tl.functions.messages import GetHistoryRequest
-from telethon.errors import ChannelPrivateError
+from aiogram.utils import markdown as md
+from aiogram.utils.exceptions import BadRequest, RetryAfter
+from telethon import TelegramClient, events, utils
+from telethon.tl.functions.channels import GetFullChannelRequest, JoinChannelRequest
+from telethon.tl.functions.messages import GetHistoryRequest, GetMessagesReactionsRequest, GetMessagesViewsRequest
+from telethon.errors import (AuthKeyUnregisteredError, ChannelInvalidError, ChannelPrivateError, FloodWaitError,
+                             PeerIdInvalidError, UserDeactivatedBanError, UserDeactivatedError)
+from telethon.tl.types import InputPeerChannel, InputPeerChat, InputPeerUser, PeerChannel, UpdateMessageReactions
+
+from workers import (KeywordMatcher, SentimentAnalyzer, init_scan_worker, init_sentiment_worker, rescore_rows,
+                     scan_rows)
 
 # Import configuration
 from config import api_id, api_hash, BOT_TOKEN, ADMIN_IDS
 
+# Extra Telegram accounts to spread sources over: [{"session": ..., "api_id": ..., "api_hash": ...}]
+try:
+    from config import ACCOUNTS
+except ImportError:
+    ACCOUNTS = []
+
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                     filename='bot_logs.log', filemode='a')
@@ -37,8 +63,177 @@ bot = Bot(token=BOT_TOKEN)
 storage = MemoryStorage()
 dp = Dispatcher(bot, storage=storage)
 
-# Initialize Telethon client
-client = TelegramClient('bot_session', api_id, api_hash)
+# Telethon sessions; the first one is the original single account
+SESSION_NAME = 'bot_session'
+ACCOUNT_SETTINGS = [{"session": SESSION_NAME, "api_id": api_id, "api_hash": api_hash}] + list(ACCOUNTS)
+
+# SQLite page cache per connection and how long to wait for a lock, in seconds
+SQLITE_CACHE_SIZE_KB = 64000
+SQLITE_BUSY_TIMEOUT = 30
+
+# Rows fetched per batch while streaming an Excel export; the first batch also sizes the columns
+EXCEL_EXPORT_BATCH = 1000
+
+# Data rows per Excel sheet: the format's limit of 1,048,576 rows minus the header
+EXCEL_MAX_ROWS = 1048575
+
+# Threads serving read queries; writes always go through a single writer
+DB_READER_THREADS = 4
+
+# Maximum number of messages Telegram returns per history request
+HISTORY_PAGE_SIZE = 100
+
+# Number of sources collected at the same time
+COLLECTOR_CONCURRENCY = 10
+
+# Bounds of the adaptive polling interval, in seconds
+MIN_POLL_INTERVAL = 60
+MAX_POLL_INTERVAL = 4 * 60 * 60
+DEFAULT_POLL_INTERVAL = 15 * 60
+
+# Number of new items the scheduler aims to pick up per poll of a source
+TARGET_ITEMS_PER_POLL = 5
+
+# Weight of the latest measurement in a source's posting velocity average
+VELOCITY_SMOOTHING = 0.3
+
+# How often the scheduler re-reads the list of monitored sources, in seconds
+SCHEDULER_REFRESH_INTERVAL = 60
+
+# "push" stores messages as Telegram delivers them and only polls to fill gaps,
+# "poll" relies on the adaptive scheduler alone
+INGESTION_MODE = "push"
+
+# Polling interval of sources covered by live updates, in seconds
+RECONCILE_INTERVAL = 60 * 60
+
+# How often live ingestion checks the connection and the list of sources, in seconds
+LIVE_CHECK_INTERVAL = 10
+
+# Allowed requests per second for each class of Telegram API calls
+REQUEST_RATE_LIMITS = {
+    "entity": 2,
+    "join": 0.2,
+    "history": 5,
+    "comments": 5,
+    "backfill": 1,
+    "metrics": 2,
+    "media": 2,
+}
+
+# How often a channel is checked for a new or removed discussion group, in seconds
+DISCUSSION_CHECK_INTERVAL = 24 * 60 * 60
+
+# Number of users kept in memory and how long a stored name is trusted, in seconds
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL = 7 * 24 * 60 * 60
+
+# Number of sources backfilled at the same time
+BACKFILL_CONCURRENCY = 1
+
+# Pause between backfill pages so live collection keeps priority, in seconds
+BACKFILL_PAGE_DELAY = 1
+
+# How often views, forwards and reactions of recent posts are refreshed, in seconds
+METRICS_REFRESH_INTERVAL = 60 * 60
+
+# Posts younger than this many days get their engagement refreshed
+METRICS_WINDOW_DAYS = 7
+
+# Maximum number of message ids per views/reactions request
+METRICS_BATCH_SIZE = 100
+
+# Download photos, videos and files of stored messages; off by default because it needs disk space
+MEDIA_DOWNLOAD_ENABLED = False
+
+# Where downloaded media is kept, one file per unique content hash
+MEDIA_DIR = 'media'
+
+# Downloads waiting in the queue before new ones are dropped, and downloads running at once
+MEDIA_QUEUE_SIZE = 1000
+MEDIA_DOWNLOAD_CONCURRENCY = 3
+
+# Largest file downloaded per media type, in bytes; other types are not downloaded
+MEDIA_SIZE_LIMITS = {
+    "photo": 10 * 1024 * 1024,
+    "video": 50 * 1024 * 1024,
+    "audio": 20 * 1024 * 1024,
+    "document": 20 * 1024 * 1024,
+}
+
+# Keyword alerts for an admin arriving within this many seconds of the last message are merged into one digest
+NOTIFY_DIGEST_WINDOW = 30
+
+# Bot API send limits: messages per second overall and per chat
+NOTIFY_GLOBAL_RATE = 25
+NOTIFY_CHAT_RATE = 1
+
+# Alerts listed in one digest message; the rest are only counted
+NOTIFY_DIGEST_MAX_ITEMS = 10
+
+# How many times a notification is retried after a 429 before it is dropped
+NOTIFY_RETRIES = 5
+
+# Worker processes and rows per chunk of retroactive keyword scans and sentiment re-scores
+SCAN_WORKERS = os.cpu_count() or 1
+SCAN_CHUNK_SIZE = 5000
+
+# Scan and re-score workers are spawned rather than forked: forking after the database and sentiment threads started
+# can leave a child holding a lock that no thread in it will ever release
+SCAN_PROCESS_CONTEXT = multiprocessing.get_context("spawn")
+
+# How often a running keyword scan or re-score reports progress to the admin, in seconds
+SCAN_PROGRESS_INTERVAL = 10
+
+# Content tables covered by keyword scans and full-text search: table -> (content type, source column, text column)
+SCAN_TABLES = {
+    "posts": ("post", "channel_name", "content"),
+    "comments": ("comment", "channel_name", "comment_text"),
+    "messages": ("message", "source", "content"),
+}
+
+# Search box syntax: "quoted phrases" or single words, a trailing * makes a word a prefix
+SEARCH_TERM_PATTERN = re.compile(r'"([^"]*)"|(\S+)')
+
+# Fuzzy search: the share of a query's trigrams a text must contain, and how many candidates each table may return
+FUZZY_MIN_SIMILARITY = 0.5
+FUZZY_CANDIDATES = 5000
+
+# The trigram tokenizer appeared in SQLite 3.34; without it there is no fuzzy search
+TRIGRAM_SEARCH_AVAILABLE = sqlite3.sqlite_version_info >= (3, 34, 0)
+
+# Transliteration of Russian letters, used to also search a query in the other alphabet
+TRANSLITERATION = {
+    "а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "е": "e", "ё": "e", "ж": "zh", "з": "z", "и": "i",
+    "й": "y", "к": "k", "л": "l", "м": "m", "н": "n", "о": "o", "п": "p", "р": "r", "с": "s", "т": "t",
+    "у": "u", "ф": "f", "х": "kh", "ц": "ts", "ч": "ch", "ш": "sh", "щ": "sch", "ъ": "", "ы": "y", "ь": "",
+    "э": "e", "ю": "yu", "я": "ya",
+}
+
+# Latin spellings of Russian letters back to the letters; the extra entries cover Latin letters with no pair
+REVERSE_TRANSLITERATION = {
+    **{latin: russian for russian, latin in reversed(TRANSLITERATION.items()) if latin},
+    "c": "к", "h": "х", "j": "дж", "q": "к", "w": "в", "x": "кс",
+}
+
+# Search results per page, and how many recent searches keep their page cursors for the navigation buttons
+SEARCH_PAGE_SIZE = 15
+SEARCH_SESSIONS = 200
+
+# Memory budget of cached search pages and counts, in bytes
+SEARCH_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+# Ingestion writes remembered for searches still running; a search older than all of them is not cached
+SEARCH_CACHE_WRITE_LOG = 1000
+
+# Points per account on the consistent hash ring that assigns sources to accounts
+ACCOUNT_RING_REPLICAS = 100
+
+# A FloodWait at least this long moves an account's sources to other accounts until it ends, in seconds
+ACCOUNT_REBALANCE_FLOOD_WAIT = 60
+
+# How many times a request is retried after a FloodWait before giving up
+FLOOD_WAIT_RETRIES = 3
 
 # Define states for conversation handlers
 class ExportStates(StatesGroup):
@@ -66,11 +261,24 @@ class SearchStates(StatesGroup):
     custom_period_end = State()
 
 # Helper functions for database operations
+def get_connection():
+    """Open the content database with the settings used for every connection"""
+    conn = sqlite3.connect('telegram_content.db', timeout=SQLITE_BUSY_TIMEOUT)
+    
+    # Safe with WAL: a crash can lose the last commits but never corrupts the database
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA cache_size = -{SQLITE_CACHE_SIZE_KB}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    return conn
+
 def init_db():
     """Initialize database and create tables if they don't exist"""
-    conn = sqlite3.connect('telegram_content.db')
+    conn = get_connection()
     cursor = conn.cursor()
     
+    # WAL lets searches and exports read while the collector writes; the mode is stored in the file
+    cursor.execute("PRAGMA journal_mode = WAL")
+    
     # Create tables if they don't exist
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS posts (
@@ -78,7 +286,8 @@ def init_db():
         date TEXT,
         channel_name TEXT,
         content TEXT,
-        message_id INTEGER
+        message_id INTEGER,
+        reply_count INTEGER
     )
     ''')
     
@@ -91,7 +300,9 @@ def init_db():
         comment_text TEXT,
         user_id INTEGER,
         username TEXT,
-        sentiment TEXT
+        sentiment TEXT,
+        message_id INTEGER,
+        post_message_id INTEGER
     )
     ''')
     
@@ -103,7 +314,8 @@ def init_db():
         content TEXT,
         user_id INTEGER,
         username TEXT,
-        media_type TEXT
+        media_type TEXT,
+        message_id INTEGER
     )
     ''')
     
@@ -113,7 +325,11 @@ def init_db():
         name TEXT UNIQUE,
         type TEXT,
         date_added TEXT,
-        is_active INTEGER DEFAULT 1
+        is_active INTEGER DEFAULT 1,
+        poll_interval REAL,
+        velocity REAL,
+        last_polled_at REAL,
+        next_poll_at REAL
     )
     ''')
     
@@ -125,12 +341,291 @@ def init_db():
     )
     ''')
     
+    # Last collected message id per source, used as min_id for incremental fetches
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS source_cursors (
+        source_name TEXT PRIMARY KEY,
+        last_message_id INTEGER DEFAULT 0,
+        updated_at TEXT
+    )
+    ''')
+    
+    # Resolved peers of monitored sources; access hashes are only valid for the session that resolved them
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS source_peers (
+        session_name TEXT,
+        source_name TEXT,
+        peer_type TEXT,
+        peer_id INTEGER,
+        access_hash INTEGER,
+        is_joined INTEGER DEFAULT 0,
+        resolved_at TEXT,
+        PRIMARY KEY (session_name, source_name)
+    )
+    ''')
+    
+    # Keyword matches found by scanning stored content; row_id is the id in the table of the content type
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS keyword_hits (
+        keyword TEXT,
+        content_type TEXT,
+        row_id INTEGER,
+        source TEXT,
+        date TEXT,
+        found_at TEXT,
+        PRIMARY KEY (keyword, content_type, row_id)
+    )
+    ''')
+    
+    # Engagement snapshots of posts, one row per refresh, to follow growth over time
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS post_metrics (
+        channel_name TEXT,
+        message_id INTEGER,
+        collected_at REAL,
+        views INTEGER,
+        forwards INTEGER,
+        reactions INTEGER,
+        replies INTEGER,
+        PRIMARY KEY (channel_name, message_id, collected_at)
+    )
+    ''')
+    
+    # Downloaded media, stored once per content hash
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS media_files (
+        file_hash TEXT PRIMARY KEY,
+        path TEXT,
+        media_type TEXT,
+        size INTEGER,
+        created_at TEXT
+    )
+    ''')
+    
+    # Telegram photo/document ids already downloaded, so cross-posted media is not fetched again
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS media_keys (
+        file_key TEXT PRIMARY KEY,
+        file_hash TEXT
+    )
+    ''')
+    
+    # Display names of Telegram users seen in collected content
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        updated_at REAL
+    )
+    ''')
+    
+    # Progress of full-history backfills: offset_id is the oldest message fetched so far
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS backfill_checkpoints (
+        source_name TEXT PRIMARY KEY,
+        offset_id INTEGER DEFAULT 0,
+        messages_done INTEGER DEFAULT 0,
+        completed INTEGER DEFAULT 0,
+        updated_at TEXT
+    )
+    ''')
+    
+    # Linked discussion group of each channel; discussion_id is NULL for channels without comments
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS channel_discussions (
+        channel_name TEXT PRIMARY KEY,
+        discussion_id INTEGER,
+        last_comment_id INTEGER DEFAULT 0,
+        checked_at REAL
+    )
+    ''')
+    
+    # Maps the copy of a post in the discussion group to the post itself
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS discussion_threads (
+        channel_name TEXT,
+        discussion_message_id INTEGER,
+        post_message_id INTEGER,
+        PRIMARY KEY (channel_name, discussion_message_id)
+    )
+    ''')
+    
+    # Databases created before incremental collection have no message ids on comments/messages
+    add_column_if_missing(cursor, "comments", "message_id", "INTEGER")
+    add_column_if_missing(cursor, "messages", "message_id", "INTEGER")
+    
+    # Comments point at their post; posts remember the last seen reply counter
+    add_column_if_missing(cursor, "comments", "post_message_id", "INTEGER")
+    add_column_if_missing(cursor, "posts", "reply_count", "INTEGER")
+    
+    # Latest engagement counters of each post; the history lives in post_metrics
+    add_column_if_missing(cursor, "posts", "views", "INTEGER")
+    add_column_if_missing(cursor, "posts", "forwards", "INTEGER")
+    add_column_if_missing(cursor, "posts", "reactions", "INTEGER")
+    
+    # Media of posts and group messages points at media_files by content hash
+    add_column_if_missing(cursor, "posts", "media_type", "TEXT")
+    add_column_if_missing(cursor, "posts", "media_hash", "TEXT")
+    add_column_if_missing(cursor, "messages", "media_hash", "TEXT")
+    
+    # Version of the lexicon that produced each comment's sentiment, NULL for labels from before versioning
+    add_column_if_missing(cursor, "comments", "sentiment_version", "TEXT")
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_comments_channel_post ON comments (channel_name, post_message_id)"
+    )
+    
+    # Adaptive polling state of each source (timestamps are unix time)
+    add_column_if_missing(cursor, "monitored_sources", "poll_interval", "REAL")
+    add_column_if_missing(cursor, "monitored_sources", "velocity", "REAL")
+    add_column_if_missing(cursor, "monitored_sources", "last_polled_at", "REAL")
+    add_column_if_missing(cursor, "monitored_sources", "next_poll_at", "REAL")
+    
+    # Each Telegram message is stored once per source
+    create_unique_index(cursor, "idx_posts_channel_message", "posts", "channel_name, message_id",
+                        dedupe_columns="channel_name, message_id")
+    create_unique_index(cursor, "idx_comments_channel_message", "comments", "channel_name, message_id",
+                        dedupe_columns="channel_name, date, user_id, comment_text")
+    create_unique_index(cursor, "idx_messages_source_message", "messages", "source, message_id",
+                        dedupe_columns="source, date, user_id, content")
+    
+    # Full-text indexes used by search, kept in sync with the content tables by triggers
+    for table in SCAN_TABLES:
+        create_search_index(cursor, table)
+        if TRIGRAM_SEARCH_AVAILABLE:
+            create_search_index(cursor, table, "trigram", tokenize="trigram")
+            
+            # Document frequency of every trigram, used to pick the rarest ones of a fuzzy query
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {table}_trigram_vocab USING fts5vocab({table}_trigram, 'row')"
+            )
+    
+    # Versioned schema changes, applied once each in order
+    applied = run_migrations(cursor)
+    
     conn.commit()
+    
+    if migrate_comment_post_references in applied:
+        # Give the space of the removed post copies back; VACUUM cannot run inside a transaction
+        logger.info("Compacting the database after removing copied post text from comments")
+        conn.execute("VACUUM")
     conn.close()
 
+def create_search_index(cursor, table, kind="fts", tokenize=None):
+    """Create an FTS5 index of a content table with its sync triggers, indexing the rows already stored"""
+    _, _, text_column = SCAN_TABLES[table]
+    index = f"{table}_{kind}"
+    options = f", tokenize='{tokenize}'" if tokenize else ""
+    
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (index,))
+    if cursor.fetchone():
+        return
+    
+    # External content: the index keeps only the terms, the text itself stays in the content table
+    cursor.execute(
+        f"CREATE VIRTUAL TABLE {index} USING fts5({text_column}, content='{table}', content_rowid='id'{options})"
+    )
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS {index}_insert AFTER INSERT ON {table} BEGIN
+        INSERT INTO {index} (rowid, {text_column}) VALUES (new.id, new.{text_column});
+    END
+    ''')
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS {index}_delete AFTER DELETE ON {table} BEGIN
+        INSERT INTO {index} ({index}, rowid, {text_column}) VALUES ('delete', old.id, old.{text_column});
+    END
+    ''')
+    # Upserts rewrite the text of every re-fetched message, so only real edits touch the index
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS {index}_update AFTER UPDATE OF {text_column} ON {table}
+    WHEN old.{text_column} IS NOT new.{text_column} BEGIN
+        INSERT INTO {index} ({index}, rowid, {text_column}) VALUES ('delete', old.id, old.{text_column});
+        INSERT INTO {index} (rowid, {text_column}) VALUES (new.id, new.{text_column});
+    END
+    ''')
+    
+    logger.info(f"Building the search index of {table}")
+    cursor.execute(f"INSERT INTO {index} ({index}) VALUES ('rebuild')")
+
+def migrate_add_timestamps(cursor):
+    """Store content dates as epoch seconds too and index them, so date ranges become index range scans"""
+    for table, (_, source_column, _) in SCAN_TABLES.items():
+        add_column_if_missing(cursor, table, "timestamp", "INTEGER")
+        
+        # Text dates are UTC, which is how strftime('%s') reads them
+        cursor.execute(f"UPDATE {table} SET timestamp = CAST(strftime('%s', date) AS INTEGER) WHERE timestamp IS NULL")
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_timestamp ON {table} (timestamp)")
+        cursor.execute(
+            f"CREATE INDEX IF NOT EXISTS idx_{table}_{source_column}_timestamp ON {table} ({source_column}, timestamp)"
+        )
+
+def migrate_comment_post_references(cursor):
+    """Link old comments to their post and drop the post text copied into them"""
+    # Comments stored before post_message_id existed are matched to their post by the copied text.
+    # The index only lives for this lookup; posts.content is never queried by equality otherwise
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_posts_channel_content ON posts (channel_name, content)")
+    posts = "posts p INDEXED BY idx_posts_channel_content"
+    
+    # Reposted texts match several posts: take the latest one published before the comment,
+    # or the earliest one if the dates do not line up
+    same_text = "p.channel_name = comments.channel_name AND p.content = comments.post_content"
+    cursor.execute(
+        "UPDATE comments SET post_message_id = COALESCE("
+        f"(SELECT MAX(p.message_id) FROM {posts} WHERE {same_text} AND p.date <= comments.date), "
+        f"(SELECT MIN(p.message_id) FROM {posts} WHERE {same_text})"
+        ") WHERE post_message_id IS NULL AND post_content IS NOT NULL"
+    )
+    cursor.execute("DROP INDEX idx_posts_channel_content")
+    
+    # A comment whose post was never stored keeps its copy, so no text is lost
+    cursor.execute(
+        "UPDATE comments SET post_content = NULL WHERE post_content IS NOT NULL AND EXISTS ("
+        "SELECT 1 FROM posts p WHERE p.channel_name = comments.channel_name AND p.message_id = comments.post_message_id)"
+    )
+    logger.info(f"Removed copied post text from {cursor.rowcount} comments")
+
+# Schema migrations in the order they were added; PRAGMA user_version holds how many have been applied.
+# Append new ones at the end and never reorder or remove them
+MIGRATIONS = [
+    migrate_add_timestamps,
+    migrate_comment_post_references,
+]
+
+def run_migrations(cursor):
+    """Apply the migrations a database has not seen yet, in the caller's transaction. Returns the applied ones"""
+    cursor.execute("PRAGMA user_version")
+    version = cursor.fetchone()[0]
+    
+    for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+        logger.info(f"Applying database migration {number}: {migration.__name__}")
+        migration(cursor)
+        cursor.execute(f"PRAGMA user_version = {number}")
+    return MIGRATIONS[version:]
+
+def add_column_if_missing(cursor, table, column, definition):
+    """Add a column to an existing table unless it is already there"""
+    cursor.execute(f"PRAGMA table_info({table})")
+    columns = [row[1] for row in cursor.fetchall()]
+    
+    if column not in columns:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+def create_unique_index(cursor, index_name, table, columns, dedupe_columns):
+    """Create a unique index, first removing duplicate rows left by earlier full re-fetches"""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?", (index_name,))
+    if cursor.fetchone():
+        return
+    
+    cursor.execute(
+        f"DELETE FROM {table} WHERE id NOT IN (SELECT MIN(id) FROM {table} GROUP BY {dedupe_columns})"
+    )
+    if cursor.rowcount > 0:
+        logger.info(f"Removed {cursor.rowcount} duplicate rows from {table}")
+    
+    cursor.execute(f"CREATE UNIQUE INDEX {index_name} ON {table} ({columns})")
+
 def add_source(source_name, source_type):
     """Add a new source to monitor"""
-    conn = sqlite3.connect('telegram_content.db')
+    conn = get_connection()
     cursor = conn.cursor()
     
     try:
@@ -148,7 +643,7 @@ def add_source(source_name, source_type):
 
 def get_sources():
     """Get all monitored sources"""
-    conn = sqlite3.connect('telegram_content.db')
+    conn = get_connection()
     cursor = conn.cursor()
     
     cursor.execute("SELECT name, type FROM monitored_sources WHERE is_active = 1")
@@ -159,7 +654,7 @@ def get_sources():
 
 def delete_source(source_name):
     """Delete a source from the monitored list"""
-    conn = sqlite3.connect('telegram_content.db')
+    conn = get_connection()
     cursor = conn.cursor()
     
     cursor.execute("DELETE FROM monitored_sources WHERE name = ?", (source_name,))
@@ -167,323 +662,778 @@ def delete_source(source_name):
     
     conn.close()
 
-def add_keyword(keyword):
-    """Add a new keyword to monitor"""
-    conn = sqlite3.connect('telegram_content.db')
+def get_source_schedules():
+    """Get active sources with their next poll time"""
+    conn = get_connection()
     cursor = conn.cursor()
     
-    try:
-        current_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        cursor.execute(
-            "INSERT INTO keywords (word, date_added) VALUES (?, ?)",
-            (keyword, current_date)
-        )
-        conn.commit()
-        return True
-    except sqlite3.IntegrityError:
-        return False
-    finally:
-        conn.close()
+    cursor.execute("SELECT name, type, next_poll_at FROM monitored_sources WHERE is_active = 1")
+    sources = cursor.fetchall()
+    
+    conn.close()
+    return sources
 
-def get_keywords():
-    """Get all monitored keywords"""
-    conn = sqlite3.connect('telegram_content.db')
+def get_poll_interval(velocity):
+    """Get the polling interval in seconds for a posting velocity in items per hour"""
+    if velocity is None:
+        return DEFAULT_POLL_INTERVAL
+    if velocity <= 0:
+        return MAX_POLL_INTERVAL
+    
+    interval = TARGET_ITEMS_PER_POLL / velocity * 3600
+    return max(MIN_POLL_INTERVAL, min(MAX_POLL_INTERVAL, interval))
+
+def update_source_schedule(source_name, new_items, polled_at, min_interval=0):
+    """Update the posting velocity of a source after a poll. Returns its next poll time"""
+    conn = get_connection()
     cursor = conn.cursor()
     
-    cursor.execute("SELECT word FROM keywords")
-    keywords = [row[0] for row in cursor.fetchall()]
+    cursor.execute("SELECT velocity, last_polled_at FROM monitored_sources WHERE name = ?", (source_name,))
+    row = cursor.fetchone()
+    velocity, last_polled_at = row if row else (None, None)
+    
+    # The first poll picks up a backlog, so velocity is only measured between two polls
+    if last_polled_at and polled_at > last_polled_at:
+        measured = new_items / ((polled_at - last_polled_at) / 3600)
+        if velocity is None:
+            velocity = measured
+        else:
+            velocity = VELOCITY_SMOOTHING * measured + (1 - VELOCITY_SMOOTHING) * velocity
     
+    poll_interval = max(get_poll_interval(velocity), min_interval)
+    next_poll_at = polled_at + poll_interval
+    
+    cursor.execute(
+        "UPDATE monitored_sources SET velocity = ?, poll_interval = ?, last_polled_at = ?, next_poll_at = ? WHERE name = ?",
+        (velocity, poll_interval, polled_at, next_poll_at, source_name)
+    )
+    conn.commit()
     conn.close()
-    return keywords
+    
+    return next_poll_at
 
-def delete_keyword(keyword):
-    """Delete a keyword from the monitored list"""
-    conn = sqlite3.connect('telegram_content.db')
+def load_source_peer(session_name, source_name):
+    """Get (peer_type, peer_id, access_hash, is_joined) cached for a source in a session"""
+    conn = get_connection()
     cursor = conn.cursor()
     
-    cursor.execute("DELETE FROM keywords WHERE word = ?", (keyword,))
-    conn.commit()
+    cursor.execute(
+        "SELECT peer_type, peer_id, access_hash, is_joined FROM source_peers WHERE session_name = ? AND source_name = ?",
+        (session_name, source_name)
+    )
+    row = cursor.fetchone()
     
     conn.close()
+    return row
 
-def get_period_dates(period):
-    """Get start and end dates based on the selected period"""
-    end_date = datetime.now()
+def save_source_peer(session_name, source_name, peer_type, peer_id, access_hash, is_joined):
+    """Cache the peer of a source as resolved by a session"""
+    conn = get_connection()
+    cursor = conn.cursor()
     
-    if period == "week":
-        start_date = end_date - timedelta(days=7)
-    elif period == "month":
-        start_date = end_date - timedelta(days=30)
-    elif period == "three_months":
-        start_date = end_date - timedelta(days=90)
-    else:  # All time
-        start_date = datetime(2000, 1, 1)  # A date far in the past
+    current_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    cursor.execute(
+        "INSERT OR REPLACE INTO source_peers "
+        "(session_name, source_name, peer_type, peer_id, access_hash, is_joined, resolved_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (session_name, source_name, peer_type, peer_id, access_hash, int(is_joined), current_date)
+    )
+    conn.commit()
     
-    return start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d")
+    conn.close()
 
-def export_data_to_excel(data_type, start_date, end_date):
-    """Export data to Excel file"""
-    conn = sqlite3.connect('telegram_content.db')
+def delete_source_peer(source_name, session_name=None):
+    """Drop the cached peer of a source in one session, or in all of them"""
+    conn = get_connection()
     cursor = conn.cursor()
     
-    wb = openpyxl.Workbook()
-    
-    # Format dates for SQL query
-    start_date_obj = datetime.strptime(start_date, "%Y-%m-%d")
-    end_date_obj = datetime.strptime(end_date, "%Y-%m-%d") + timedelta(days=1)  # Include the end date
-    
-    start_date_str = start_date_obj.strftime("%Y-%m-%d")
-    end_date_str = end_date_obj.strftime("%Y-%m-%d")
-    
-    if data_type == "posts" or data_type == "all":
-        # Export posts
-        ws_posts = wb.active
-        ws_posts.title = "Posts"
-        
-        # Add headers
-        headers = ["Date", "Channel", "Content"]
-        for col_num, header in enumerate(headers, 1):
-            cell = ws_posts.cell(row=1, column=col_num)
-            cell.value = header
-            cell.font = Font(bold=True)
-            cell.alignment = Alignment(horizontal='center')
-            cell.fill = PatternFill(start_color="D3D3D3", end_color="D3D3D3", fill_type="solid")
-        
-        # Get posts data
-        cursor.execute(
-            "SELECT date, channel_name, content FROM posts WHERE date BETWEEN ? AND ?",
-            (start_date_str, end_date_str)
-        )
-        posts = cursor.fetchall()
-        
-        # Add data to worksheet
-        for row_num, post in enumerate(posts, 2):
-            for col_num, value in enumerate(post, 1):
-                ws_posts.cell(row=row_num, column=col_num).value = value
-    
-    if data_type == "comments" or data_type == "all":
-        # Export comments
-        if data_type == "comments":
-            ws_comments = wb.active
-            ws_comments.title = "Comments"
-        else:
-            ws_comments = wb.create_sheet("Comments")
-        
-        # Add headers
-        headers = ["Date", "Channel", "Post Content", "Comment", "User ID", "Username", "Sentiment"]
-        for col_num, header in enumerate(headers, 1):
-            cell = ws_comments.cell(row=1, column=col_num)
-            cell.value = header
-            cell.font = Font(bold=True)
-            cell.alignment = Alignment(horizontal='center')
-            cell.fill = PatternFill(start_color="D3D3D3", end_color="D3D3D3", fill_type="solid")
-        
-        # Get comments data
-        cursor.execute(
-            "SELECT date, channel_name, post_content, comment_text, user_id, username, sentiment FROM comments WHERE date BETWEEN ? AND ?",
-            (start_date_str, end_date_str)
-        )
-        comments = cursor.fetchall()
-        
-        # Add data to worksheet
-        for row_num, comment in enumerate(comments, 2):
-            for col_num, value in enumerate(comment, 1):
-                ws_comments.cell(row=row_num, column=col_num).value = value
-    
-    if data_type == "messages" or data_type == "all":
-        # Export messages
-        if data_type == "messages":
-            ws_messages = wb.active
-            ws_messages.title = "Messages"
-        else:
-            ws_messages = wb.create_sheet("Messages")
-        
-        # Add headers
-        headers = ["Date", "Source", "Content", "User ID", "Username", "Media Type"]
-        for col_num, header in enumerate(headers, 1):
-            cell = ws_messages.cell(row=1, column=col_num)
-            cell.value = header
-            cell.font = Font(bold=True)
-            cell.alignment = Alignment(horizontal='center')
-            cell.fill = PatternFill(start_color="D3D3D3", end_color="D3D3D3", fill_type="solid")
-        
-        # Get messages data
-        cursor.execute(
-            "SELECT date, source, content, user_id, username, media_type FROM messages WHERE date BETWEEN ? AND ?",
-            (start_date_str, end_date_str)
-        )
-        messages = cursor.fetchall()
-        
-        # Add data to worksheet
-        for row_num, message in enumerate(messages, 2):
-            for col_num, value in enumerate(message, 1):
-                ws_messages.cell(row=row_num, column=col_num).value = value
-    
-    # Adjust column widths
-    for sheet in wb:
-        for column in sheet.columns:
-            max_length = 0
-            column_letter = column[0].column_letter
-            for cell in column:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = min(len(str(cell.value)), 50)  # Cap at 50 to avoid too wide columns
-                except:
-                    pass
-            adjusted_width = (max_length + 2)
-            sheet.column_dimensions[column_letter].width = adjusted_width
+    if session_name:
+        cursor.execute("DELETE FROM source_peers WHERE session_name = ? AND source_name = ?", (session_name, source_name))
+    else:
+        cursor.execute("DELETE FROM source_peers WHERE source_name = ?", (source_name,))
+    conn.commit()
     
-    # Save the workbook
-    filename = f"temp/export_{data_type}_{start_date}_to_{end_date}.xlsx"
-    wb.save(filename)
     conn.close()
-    
-    return filename
 
-def export_data_to_json(data_type, start_date, end_date):
-    """Export data to JSON file"""
-    conn = sqlite3.connect('telegram_content.db')
+def get_source_cursor(source_name):
+    """Get the id of the last message collected from a source"""
+    conn = get_connection()
     cursor = conn.cursor()
     
-    # Format dates for SQL query
-    start_date_obj = datetime.strptime(start_date, "%Y-%m-%d")
-    end_date_obj = datetime.strptime(end_date, "%Y-%m-%d") + timedelta(days=1)  # Include the end date
-    
-    start_date_str = start_date_obj.strftime("%Y-%m-%d")
-    end_date_str = end_date_obj.strftime("%Y-%m-%d")
-    
-    data = {}
-    
-    if data_type == "posts" or data_type == "all":
-        # Export posts
-        cursor.execute(
-            "SELECT date, channel_name, content FROM posts WHERE date BETWEEN ? AND ?",
-            (start_date_str, end_date_str)
-        )
-        posts = cursor.fetchall()
-        
-        posts_data = []
-        for post in posts:
-            posts_data.append({
-                "date": post[0],
-                "channel": post[1],
-                "content": post[2]
-            })
-        
-        data["posts"] = posts_data
-    
-    if data_type == "comments" or data_type == "all":
-        # Export comments
-        cursor.execute(
-            "SELECT date, channel_name, post_content, comment_text, user_id, username, sentiment FROM comments WHERE date BETWEEN ? AND ?",
-            (start_date_str, end_date_str)
-        )
-        comments = cursor.fetchall()
-        
-        comments_data = []
-        for comment in comments:
-            comments_data.append({
-                "date": comment[0],
-                "channel": comment[1],
-                "post_content": comment[2],
-                "comment": comment[3],
-                "user_id": comment[4],
-                "username": comment[5],
-                "sentiment": comment[6]
-            })
-        
-        data["comments"] = comments_data
-    
-    if data_type == "messages" or data_type == "all":
-        # Export messages
-        cursor.execute(
-            "SELECT date, source, content, user_id, username, media_type FROM messages WHERE date BETWEEN ? AND ?",
-            (start_date_str, end_date_str)
-        )
-        messages = cursor.fetchall()
-        
-        messages_data = []
-        for message in messages:
-            messages_data.append({
-                "date": message[0],
-                "source": message[1],
-                "content": message[2],
-                "user_id": message[3],
-                "username": message[4],
-                "media_type": message[5]
-            })
-        
-        data["messages"] = messages_data
-    
-    # Save to JSON file
-    filename = f"temp/export_{data_type}_{start_date}_to_{end_date}.json"
-    with open(filename, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
+    cursor.execute("SELECT last_message_id FROM source_cursors WHERE source_name = ?", (source_name,))
+    row = cursor.fetchone()
     
     conn.close()
-    return filename
+    return row[0] if row else 0
+
+def update_source_cursor(cursor, source_name, last_message_id):
+    """Move the high-water mark of a source forward (never backwards)"""
+    current_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    cursor.execute(
+        "INSERT INTO source_cursors (source_name, last_message_id, updated_at) VALUES (?, ?, ?) "
+        "ON CONFLICT(source_name) DO UPDATE SET "
+        "last_message_id = MAX(last_message_id, excluded.last_message_id), updated_at = excluded.updated_at",
+        (source_name, last_message_id, current_date)
+    )
 
-def search_content(query, start_date, end_date):
-    """Search content based on query and period"""
-    conn = sqlite3.connect('telegram_content.db')
+def get_channel_discussion(channel_name):
+    """Get (discussion_id, last_comment_id, checked_at) cached for a channel"""
+    conn = get_connection()
     cursor = conn.cursor()
     
-    # Format dates for SQL query
-    start_date_obj = datetime.strptime(start_date, "%Y-%m-%d")
-    end_date_obj = datetime.strptime(end_date, "%Y-%m-%d") + timedelta(days=1)  # Include the end date
-    
-    start_date_str = start_date_obj.strftime("%Y-%m-%d")
-    end_date_str = end_date_obj.strftime("%Y-%m-%d")
+    cursor.execute(
+        "SELECT discussion_id, last_comment_id, checked_at FROM channel_discussions WHERE channel_name = ?",
+        (channel_name,)
+    )
+    row = cursor.fetchone()
     
-    results = []
+    conn.close()
+    return row
+
+def save_channel_discussion(channel_name, discussion_id):
+    """Cache the discussion group of a channel, keeping the comment cursor if the group did not change"""
+    conn = get_connection()
+    cursor = conn.cursor()
     
-    # Search in posts
     cursor.execute(
-        "SELECT date, channel_name, content, 'post' as type FROM posts WHERE content LIKE ? AND date BETWEEN ? AND ?",
-        (f"%{query}%", start_date_str, end_date_str)
+        "INSERT INTO channel_discussions (channel_name, discussion_id, last_comment_id, checked_at) VALUES (?, ?, 0, ?) "
+        "ON CONFLICT(channel_name) DO UPDATE SET "
+        "last_comment_id = CASE WHEN discussion_id IS excluded.discussion_id THEN last_comment_id ELSE 0 END, "
+        "discussion_id = excluded.discussion_id, checked_at = excluded.checked_at",
+        (channel_name, discussion_id, time.time())
     )
-    posts = cursor.fetchall()
-    results.extend(posts)
+    conn.commit()
     
-    # Search in comments
+    conn.close()
+
+def update_discussion_cursor(cursor, channel_name, last_comment_id):
+    """Move the comment cursor of a channel forward"""
+    cursor.execute(
+        "UPDATE channel_discussions SET last_comment_id = MAX(last_comment_id, ?) WHERE channel_name = ?",
+        (last_comment_id, channel_name)
+    )
+
+def save_discussion_thread(cursor, channel_name, discussion_message_id, post_message_id):
+    """Remember which post a discussion group thread belongs to"""
     cursor.execute(
-        "SELECT date, channel_name, comment_text, 'comment' as type FROM comments WHERE comment_text LIKE ? AND date BETWEEN ? AND ?",
-        (f"%{query}%", start_date_str, end_date_str)
+        "INSERT OR REPLACE INTO discussion_threads (channel_name, discussion_message_id, post_message_id) VALUES (?, ?, ?)",
+        (channel_name, discussion_message_id, post_message_id)
     )
-    comments = cursor.fetchall()
-    results.extend(comments)
+
+def get_thread_posts(channel_name, discussion_message_ids):
+    """Get {discussion_message_id: post_message_id} for known threads"""
+    if not discussion_message_ids:
+        return {}
+    
+    conn = get_connection()
+    cursor = conn.cursor()
     
-    # Search in messages
+    placeholders = ", ".join("?" for _ in discussion_message_ids)
     cursor.execute(
-        "SELECT date, source, content, 'message' as type FROM messages WHERE content LIKE ? AND date BETWEEN ? AND ?",
-        (f"%{query}%", start_date_str, end_date_str)
+        f"SELECT discussion_message_id, post_message_id FROM discussion_threads "
+        f"WHERE channel_name = ? AND discussion_message_id IN ({placeholders})",
+        (channel_name, *discussion_message_ids)
     )
-    messages = cursor.fetchall()
-    results.extend(messages)
+    thread_posts = dict(cursor.fetchall())
     
     conn.close()
-    return results
+    return thread_posts
 
-def analyze_sentiment(text):
-    """Simple sentiment analysis based on keywords"""
-    positive_words = ['хорошо', 'отлично', 'супер', 'класс', 'радость', 'счастье', 'великолепно', 'прекрасно']
-    negative_words = ['плохо', 'ужасно', 'отстой', 'проблема', 'неудача', 'грустно', 'разочарован', 'жаль']
+def get_post_reply_states(channel_name, message_ids):
+    """Get {message_id: (reply_count, stored comments, newest stored comment id)} of stored posts"""
+    if not message_ids:
+        return {}
     
-    text = text.lower()
+    conn = get_connection()
+    cursor = conn.cursor()
     
-    positive_count = sum(1 for word in positive_words if word in text)
-    negative_count = sum(1 for word in negative_words if word in text)
+    placeholders = ", ".join("?" for _ in message_ids)
+    cursor.execute(
+        f"SELECT p.message_id, p.reply_count, COUNT(c.id), MAX(c.message_id) FROM posts p "
+        f"LEFT JOIN comments c ON c.channel_name = p.channel_name AND c.post_message_id = p.message_id "
+        f"WHERE p.channel_name = ? AND p.message_id IN ({placeholders}) GROUP BY p.message_id",
+        (channel_name, *message_ids)
+    )
+    states = {row[0]: row[1:] for row in cursor.fetchall()}
     
-    if positive_count > negative_count:
-        return "positive"
-    elif negative_count > positive_count:
-        return "negative"
-    else:
-        return "neutral"
+    conn.close()
+    return states
+
+def set_post_reply_count(cursor, channel_name, message_id, reply_count):
+    """Store the last seen reply counter of a post"""
+    cursor.execute(
+        "UPDATE posts SET reply_count = ? WHERE channel_name = ? AND message_id = ?",
+        (reply_count, channel_name, message_id)
+    )
+
+def create_backfill_checkpoint(source_name):
+    """Register a source for backfilling unless it already has a checkpoint"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    current_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    cursor.execute(
+        "INSERT OR IGNORE INTO backfill_checkpoints (source_name, updated_at) VALUES (?, ?)",
+        (source_name, current_date)
+    )
+    conn.commit()
+    
+    conn.close()
+
+def get_backfill_checkpoint(source_name):
+    """Get (offset_id, messages_done, completed) of a source's backfill"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute(
+        "SELECT offset_id, messages_done, completed FROM backfill_checkpoints WHERE source_name = ?",
+        (source_name,)
+    )
+    row = cursor.fetchone()
+    
+    conn.close()
+    return row if row else (0, 0, 0)
+
+def save_backfill_checkpoint(cursor, source_name, offset_id, messages_done, completed):
+    """Store backfill progress; committed together with the page it belongs to"""
+    current_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    cursor.execute(
+        "INSERT INTO backfill_checkpoints (source_name, offset_id, messages_done, completed, updated_at) "
+        "VALUES (?, ?, ?, ?, ?) "
+        "ON CONFLICT(source_name) DO UPDATE SET offset_id = excluded.offset_id, "
+        "messages_done = excluded.messages_done, completed = excluded.completed, updated_at = excluded.updated_at",
+        (source_name, offset_id, messages_done, int(completed), current_date)
+    )
+
+def get_pending_backfills():
+    """Get active sources whose backfill has not finished"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute(
+        "SELECT s.name, s.type FROM backfill_checkpoints b "
+        "JOIN monitored_sources s ON s.name = b.source_name "
+        "WHERE b.completed = 0 AND s.is_active = 1"
+    )
+    sources = cursor.fetchall()
+    
+    conn.close()
+    return sources
+
+def get_media_hash(file_key):
+    """Get the content hash of an already downloaded Telegram photo/document, or None"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute("SELECT file_hash FROM media_keys WHERE file_key = ?", (file_key,))
+    row = cursor.fetchone()
+    
+    conn.close()
+    return row[0] if row else None
+
+def save_media(table, source_column, source, message_id, file_key, file_hash, path=None, media_type=None, size=None):
+    """Link a stored message to its media; path is only given for a newly downloaded file"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    if path:
+        current_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        cursor.execute(
+            "INSERT OR IGNORE INTO media_files (file_hash, path, media_type, size, created_at) VALUES (?, ?, ?, ?, ?)",
+            (file_hash, path, media_type, size, current_date)
+        )
+        cursor.execute(
+            "INSERT OR REPLACE INTO media_keys (file_key, file_hash) VALUES (?, ?)",
+            (file_key, file_hash)
+        )
+    cursor.execute(
+        f"UPDATE {table} SET media_hash = ? WHERE {source_column} = ? AND message_id = ?",
+        (file_hash, source, message_id)
+    )
+    conn.commit()
+    
+    conn.close()
+
+def get_recent_post_ids(channel_name, since):
+    """Get message ids of a channel's posts published after the given unix time"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute(
+        "SELECT message_id FROM posts WHERE channel_name = ? AND timestamp >= ? ORDER BY message_id",
+        (channel_name, since)
+    )
+    message_ids = [row[0] for row in cursor.fetchall()]
+    
+    conn.close()
+    return message_ids
+
+def save_post_metrics(rows):
+    """Append (channel_name, message_id, collected_at, views, forwards, reactions, replies) snapshots and update the posts"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    cursor.executemany(
+        "INSERT OR REPLACE INTO post_metrics (channel_name, message_id, collected_at, views, forwards, reactions, replies) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        rows
+    )
+    cursor.executemany(
+        "UPDATE posts SET views = ?, forwards = ?, reactions = ? WHERE channel_name = ? AND message_id = ?",
+        [(views, forwards, reactions, channel_name, message_id)
+         for channel_name, message_id, _, views, forwards, reactions, _ in rows]
+    )
+    conn.commit()
+    
+    conn.close()
+
+def add_keyword(keyword):
+    """Add a new keyword to monitor. Returns its id, or False if it is already monitored"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        current_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        cursor.execute(
+            "INSERT INTO keywords (word, date_added) VALUES (?, ?)",
+            (keyword, current_date)
+        )
+        conn.commit()
+        return cursor.lastrowid
+    except sqlite3.IntegrityError:
+        return False
+    finally:
+        conn.close()
+
+def get_keywords():
+    """Get all monitored keywords"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute("SELECT word FROM keywords")
+    keywords = [row[0] for row in cursor.fetchall()]
+    
+    conn.close()
+    return keywords
+
+def get_keyword(keyword_id):
+    """Get a monitored keyword by its id, or None if it was deleted"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute("SELECT word FROM keywords WHERE id = ?", (keyword_id,))
+    row = cursor.fetchone()
+    
+    conn.close()
+    return row[0] if row else None
+
+def delete_keyword(keyword):
+    """Delete a keyword from the monitored list"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute("DELETE FROM keywords WHERE word = ?", (keyword,))
+    conn.commit()
+    
+    conn.close()
+
+def count_rows(table):
+    """Get the number of rows in a content table"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute(f"SELECT COUNT(*) FROM {table}")
+    count = cursor.fetchone()[0]
+    
+    conn.close()
+    return count
+
+def get_scan_chunk(table, after_id, limit):
+    """Get (id, source, date, text) rows of a content table with ids above after_id"""
+    _, source_column, text_column = SCAN_TABLES[table]
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute(
+        f"SELECT id, {source_column}, date, {text_column} FROM {table} WHERE id > ? ORDER BY id LIMIT ?",
+        (after_id, limit)
+    )
+    rows = cursor.fetchall()
+    
+    conn.close()
+    return rows
+
+def save_keyword_hits(hits):
+    """Store (keyword, content_type, row_id, source, date) matches, ignoring ones already found"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    current_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    cursor.executemany(
+        "INSERT OR IGNORE INTO keyword_hits (keyword, content_type, row_id, source, date, found_at) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        [(*hit, current_date) for hit in hits]
+    )
+    conn.commit()
+    
+    conn.close()
+
+def count_stale_sentiments(version):
+    """Get the number of comments whose sentiment was not produced by the given lexicon version"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute("SELECT COUNT(*) FROM comments WHERE sentiment_version IS NOT ?", (version,))
+    count = cursor.fetchone()[0]
+    
+    conn.close()
+    return count
+
+def get_stale_sentiment_chunk(version, after_id, limit):
+    """Get (id, comment_text) of comments above after_id whose sentiment is not at the given version"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute(
+        "SELECT id, comment_text FROM comments WHERE id > ? AND sentiment_version IS NOT ? ORDER BY id LIMIT ?",
+        (after_id, version, limit)
+    )
+    rows = cursor.fetchall()
+    
+    conn.close()
+    return rows
+
+def save_sentiments(version, labels):
+    """Store re-scored (sentiment, comment id) pairs with the lexicon version that produced them"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    cursor.executemany(
+        "UPDATE comments SET sentiment = ?, sentiment_version = ? WHERE id = ?",
+        [(label, version, comment_id) for label, comment_id in labels]
+    )
+    conn.commit()
+    
+    conn.close()
+
+def get_period_dates(period):
+    """Get start and end dates based on the selected period"""
+    end_date = datetime.now()
+    
+    if period == "week":
+        start_date = end_date - timedelta(days=7)
+    elif period == "month":
+        start_date = end_date - timedelta(days=30)
+    elif period == "three_months":
+        start_date = end_date - timedelta(days=90)
+    else:  # All time
+        start_date = datetime(2000, 1, 1)  # A date far in the past
+    
+    return start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d")
+
+def get_period_timestamps(start_date, end_date):
+    """Get the unix time range [start, end) covering every day from start_date to end_date inclusive, in UTC like the stored dates"""
+    start = datetime.strptime(start_date, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+    end = datetime.strptime(end_date, "%Y-%m-%d").replace(tzinfo=timezone.utc) + timedelta(days=1)
+    return int(start.timestamp()), int(end.timestamp())
+
+# Exported data: data type -> (Excel sheet title, Excel headers, JSON keys, query over a [start, end) timestamp range)
+EXPORT_QUERIES = {
+    "posts": (
+        "Posts",
+        ["Date", "Channel", "Content", "Views", "Forwards", "Reactions"],
+        ["date", "channel", "content", "views", "forwards", "reactions"],
+        "SELECT date, channel_name, content, views, forwards, reactions FROM posts WHERE timestamp >= ? AND timestamp < ?"
+    ),
+    "comments": (
+        "Comments",
+        ["Date", "Channel", "Post Content", "Comment", "User ID", "Username", "Sentiment"],
+        ["date", "channel", "post_content", "comment", "user_id", "username", "sentiment"],
+        "SELECT c.date, c.channel_name, COALESCE(p.content, c.post_content), c.comment_text, c.user_id, c.username, c.sentiment "
+        "FROM comments c LEFT JOIN posts p ON p.channel_name = c.channel_name AND p.message_id = c.post_message_id "
+        "WHERE c.timestamp >= ? AND c.timestamp < ?"
+    ),
+    "messages": (
+        "Messages",
+        ["Date", "Source", "Content", "User ID", "Username", "Media Type"],
+        ["date", "source", "content", "user_id", "username", "media_type"],
+        "SELECT date, source, content, user_id, username, media_type FROM messages WHERE timestamp >= ? AND timestamp < ?"
+    ),
+}
+
+def export_cursors(cursor, data_type, start_date, end_date):
+    """Run the export query of each requested data type over the period. Yields (data type, query entry) with the rows pending on the cursor"""
+    start_timestamp, end_timestamp = get_period_timestamps(start_date, end_date)
+    for export_type, export in EXPORT_QUERIES.items():
+        if data_type == export_type or data_type == "all":
+            cursor.execute(export[3], (start_timestamp, end_timestamp))
+            yield export_type, export
+
+def export_data_to_excel(data_type, start_date, end_date):
+    """Export data to Excel file, streaming rows so memory use does not depend on the size of the period"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    # Write-only mode keeps no cells in memory: each appended row goes straight to a temporary file
+    wb = openpyxl.Workbook(write_only=True)
+    
+    for _, (title, headers, _, _) in export_cursors(cursor, data_type, start_date, end_date):
+        rows = cursor.fetchmany(EXCEL_EXPORT_BATCH)
+        part = 1
+        
+        # An empty period still gets a sheet with headers
+        while True:
+            ws = wb.create_sheet(title if part == 1 else f"{title} ({part})")
+            write_excel_header(ws, headers, rows)
+            written = 0
+            
+            while rows and written < EXCEL_MAX_ROWS:
+                fitting = rows[:EXCEL_MAX_ROWS - written]
+                for row in fitting:
+                    ws.append(row)
+                written += len(fitting)
+                rows = rows[len(fitting):] or cursor.fetchmany(EXCEL_EXPORT_BATCH)
+            
+            # A sheet holds at most about a million rows; the rest continues on the next one
+            if not rows:
+                break
+            part += 1
+    
+    # Save the workbook
+    filename = f"temp/export_{data_type}_{start_date}_to_{end_date}.xlsx"
+    wb.save(filename)
+    conn.close()
+    
+    return filename
+
+def write_excel_header(ws, headers, sample):
+    """Size the columns from the first batch of rows and write the header; must run before any row is appended"""
+    for col_num, header in enumerate(headers, 1):
+        max_length = len(header)
+        for row in sample:
+            if row[col_num - 1] is not None:
+                max_length = max(max_length, min(len(str(row[col_num - 1])), 50))  # Cap at 50 to avoid too wide columns
+        ws.column_dimensions[get_column_letter(col_num)].width = max_length + 2
+    
+    header_cells = []
+    for header in headers:
+        cell = WriteOnlyCell(ws, value=header)
+        cell.font = Font(bold=True)
+        cell.alignment = Alignment(horizontal='center')
+        cell.fill = PatternFill(start_color="D3D3D3", end_color="D3D3D3", fill_type="solid")
+        header_cells.append(cell)
+    ws.append(header_cells)
+
+def export_data_to_json(data_type, start_date, end_date):
+    """Export data to JSON file"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    data = {}
+    for export_type, (_, _, keys, _) in export_cursors(cursor, data_type, start_date, end_date):
+        data[export_type] = [dict(zip(keys, row)) for row in cursor.fetchall()]
+    
+    # Save to JSON file
+    filename = f"temp/export_{data_type}_{start_date}_to_{end_date}.json"
+    with open(filename, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=4)
+    
+    conn.close()
+    return filename
+
+def build_match_query(query):
+    """Turn a search query into an FTS5 expression requiring every word and phrase. Returns None if nothing is searchable"""
+    terms = []
+    for phrase, word in SEARCH_TERM_PATTERN.findall(query):
+        if phrase.strip():
+            terms.append(f'"{phrase}"')
+        elif word.strip('"*'):
+            # Quoted, so FTS5 operators and punctuation typed by the user are searched as text
+            term = '"' + word.strip('"*').replace('"', '""') + '"'
+            terms.append(term + "*" if word.endswith("*") else term)
+    
+    return " ".join(terms) if terms else None
+
+def search_selects(query, start_date, end_date, columns, after=None):
+    """Build one SELECT per content table matching the query and period. Returns (selects, params)"""
+    match_query = build_match_query(query)
+    start_timestamp, end_timestamp = get_period_timestamps(start_date, end_date)
+    
+    selects = []
+    params = []
+    for kind, (table, (content_type, source_column, text_column)) in enumerate(SCAN_TABLES.items()):
+        select = (
+            f"SELECT {columns.format(source=source_column, text=text_column, type=content_type, kind=kind)} "
+            f"FROM {table}_fts JOIN {table} t ON t.id = {table}_fts.rowid "
+            f"WHERE {table}_fts MATCH ? AND t.timestamp >= ? AND t.timestamp < ?"
+        )
+        params.extend([match_query, start_timestamp, end_timestamp])
+    
+        # Keyset: continue strictly after the last row shown, in (date, kind, id) order
+        if after:
+            select += f" AND (t.date, {kind}, t.id) < (?, ?, ?)"
+            params.extend(after)
+        selects.append(select)
+    
+    return selects, params
+
+def search_content(query, start_date, end_date, after=None, limit=SEARCH_PAGE_SIZE):
+    """Get one page of search results, newest first. Returns (rows, cursor of the next page or None)"""
+    if not build_match_query(query):
+        return [], None
+    
+    selects, params = search_selects(
+        query, start_date, end_date, "t.date, t.{source}, t.{text}, '{type}' as type, {kind} as kind, t.id", after
+    )
+    
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    # Posts, comments and messages are searched through their full-text indexes; one extra row tells if there is a next page
+    cursor.execute(
+        " UNION ALL ".join(selects) + " ORDER BY date DESC, kind DESC, id DESC LIMIT ?",
+        (*params, limit + 1)
+    )
+    rows = cursor.fetchall()
+    
+    conn.close()
+    
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = (rows[-1][0], rows[-1][4], rows[-1][5])
+    return [row[:4] for row in rows], next_cursor
+
+def count_search_results(query, start_date, end_date):
+    """Get the number of search matches without loading them"""
+    if not build_match_query(query):
+        return 0
+    
+    selects, params = search_selects(query, start_date, end_date, "COUNT(*)")
+    
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute(f"SELECT {' + '.join(f'({select})' for select in selects)}", params)
+    count = cursor.fetchone()[0]
+    
+    conn.close()
+    return count
+
+def transliterate(text):
+    """Spell Russian text in Latin letters, or Latin text in Russian letters"""
+    if any(char in TRANSLITERATION for char in text):
+        return "".join(TRANSLITERATION.get(char, char) for char in text)
+    
+    result = []
+    i = 0
+    while i < len(text):
+        # Longest spelling first, so "sh" becomes "ш" rather than "сх"
+        for length in (3, 2, 1):
+            russian = REVERSE_TRANSLITERATION.get(text[i:i + length])
+            if russian is not None:
+                result.append(russian)
+                i += length
+                break
+        else:
+            result.append(text[i])
+            i += 1
+    return "".join(result)
+
+def get_trigrams(text):
+    """Get the distinct three-character sequences of a text, as the trigram tokenizer splits it"""
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+def fuzzy_search_matches(query, start_date, end_date):
+    """Find texts sharing most trigrams with the query or its transliteration. Returns (matches best first, capped)"""
+    # Padded with spaces so the first and last letters count as much as the middle ones
+    query = " ".join(query.lower().split())
+    variants = [get_trigrams(f" {variant} ") for variant in {query, transliterate(query)}]
+    variants = [trigrams for trigrams in variants if trigrams]
+    if not variants:
+        return [], False
+    
+    start_timestamp, end_timestamp = get_period_timestamps(start_date, end_date)
+    
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    matches = []
+    truncated = False
+    for kind, (table, (_, _, text_column)) in enumerate(SCAN_TABLES.items()):
+        # A text sharing at least the minimum share of a query's trigrams contains one of any
+        # len - minimum + 1 of them, so only the rarest ones are looked up and the candidates stay few
+        terms = set()
+        for trigrams in variants:
+            cursor.execute(
+                f"SELECT term, doc FROM {table}_trigram_vocab WHERE term IN ({', '.join('?' for _ in trigrams)})",
+                list(trigrams)
+            )
+            frequency = dict(cursor.fetchall())
+            needed = len(trigrams) - math.ceil(FUZZY_MIN_SIMILARITY * len(trigrams)) + 1
+            terms.update(sorted(trigrams, key=lambda trigram: frequency.get(trigram, 0))[:needed])
+    
+        # Newest rows first, so a capped search drops the oldest candidates rather than the latest ones
+        cursor.execute(
+            f"SELECT t.id, t.date, t.{text_column} FROM {table}_trigram JOIN {table} t ON t.id = {table}_trigram.rowid "
+            f"WHERE {table}_trigram MATCH ? AND t.timestamp >= ? AND t.timestamp < ? "
+            f"ORDER BY {table}_trigram.rowid DESC LIMIT ?",
+            (" OR ".join('"' + term.replace('"', '""') + '"' for term in terms),
+             start_timestamp, end_timestamp, FUZZY_CANDIDATES)
+        )
+        candidates = cursor.fetchall()
+        truncated = truncated or len(candidates) == FUZZY_CANDIDATES
+        for row_id, date, text in candidates:
+            text = f" {(text or '').lower()} "
+            similarity = max(sum(1 for trigram in trigrams if trigram in text) / len(trigrams) for trigrams in variants)
+            if similarity >= FUZZY_MIN_SIMILARITY:
+                matches.append((round(similarity, 3), date, kind, row_id))
+    
+    conn.close()
+    
+    matches.sort(reverse=True)
+    return matches, truncated
+
+def get_search_rows(matches):
+    """Load (date, source, text, type) of (similarity, date, kind, id) matches, in the same order"""
+    tables = list(SCAN_TABLES.items())
+    ids_by_kind = {}
+    for _, _, kind, row_id in matches:
+        ids_by_kind.setdefault(kind, []).append(row_id)
+    
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    rows = {}
+    for kind, row_ids in ids_by_kind.items():
+        table, (content_type, source_column, text_column) = tables[kind]
+        cursor.execute(
+            f"SELECT id, date, {source_column}, {text_column} FROM {table} "
+            f"WHERE id IN ({', '.join('?' for _ in row_ids)})",
+            row_ids
+        )
+        for row_id, date, source, text in cursor.fetchall():
+            rows[(kind, row_id)] = (date, source, text, content_type)
+    
+    conn.close()
+    return [rows[(kind, row_id)] for _, _, kind, row_id in matches if (kind, row_id) in rows]
+
+# Loaded on startup: spawned scan and re-score workers import this script again and must not read the lexicon
+sentiment_analyzer = None
+
+# Comment batches are scored here so ingestion never waits on the event loop
+sentiment_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sentiment")
+
+def classify_sentiments(texts):
+    """Label a batch of texts; module-level so it can be sent to a worker pool"""
+    return sentiment_analyzer.classify(texts)
+
+def analyze_sentiment(text):
+    """Simple sentiment analysis based on keywords"""
+    return sentiment_analyzer.classify([text])[0]
 
 def get_statistics():
     """Get general statistics"""
-    conn = sqlite3.connect('telegram_content.db')
+    conn = get_connection()
     cursor = conn.cursor()
     
     # Total counts
@@ -502,239 +1452,1832 @@ def get_statistics():
     )
     top_channels = cursor.fetchall()
     
-    # Posts by day of week
-    cursor.execute(
-        "SELECT strftime('%w', date) as day_of_week, COUNT(*) as count FROM posts GROUP BY day_of_week ORDER BY day_of_week"
-    )
-    posts_by_day = cursor.fetchall()
+    # Posts by day of week
+    cursor.execute(
+        "SELECT strftime('%w', date) as day_of_week, COUNT(*) as count FROM posts GROUP BY day_of_week ORDER BY day_of_week"
+    )
+    posts_by_day = cursor.fetchall()
+    
+    # Comment sentiment distribution; labels from other lexicon versions are counted apart until re-scored
+    cursor.execute(
+        "SELECT sentiment, COUNT(*) as count FROM comments WHERE sentiment_version = ? GROUP BY sentiment",
+        (sentiment_analyzer.version,)
+    )
+    sentiment_distribution = cursor.fetchall()
+    
+    cursor.execute("SELECT COUNT(*) FROM comments WHERE sentiment_version IS NOT ?", (sentiment_analyzer.version,))
+    stale_sentiment_count = cursor.fetchone()[0]
+    
+    # Media type distribution
+    cursor.execute(
+        "SELECT media_type, COUNT(*) as count FROM messages WHERE media_type IS NOT NULL GROUP BY media_type"
+    )
+    media_distribution = cursor.fetchall()
+    
+    conn.close()
+    
+    # Create charts
+    # Day of week activity chart
+    days = ["Sun", "Mon", "Tue", "Wed", "Thu", "Fri", "Sat"]
+    counts = [0] * 7
+    for day, count in posts_by_day:
+        counts[int(day)] = count
+    
+    plt.figure(figsize=(10, 6))
+    plt.bar(days, counts, color='skyblue')
+    plt.title('Activity by Day of Week')
+    plt.xlabel('Day')
+    plt.ylabel('Number of Posts')
+    plt.grid(True, linestyle='--', alpha=0.7)
+    plt.savefig('temp/day_activity_chart.png')
+    plt.close()
+    
+    # Sentiment distribution chart
+    sentiments = []
+    sentiment_counts = []
+    for sentiment, count in sentiment_distribution:
+        sentiments.append(sentiment)
+        sentiment_counts.append(count)
+    
+    plt.figure(figsize=(8, 8))
+    colors = ['green', 'red', 'gray']
+    plt.pie(sentiment_counts, labels=sentiments, autopct='%1.1f%%', startangle=140, colors=colors)
+    plt.axis('equal')
+    plt.title('Comment Sentiment Distribution')
+    plt.savefig('temp/sentiment_chart.png')
+    plt.close()
+    
+    # Media type distribution chart
+    media_types = []
+    media_counts = []
+    for media_type, count in media_distribution:
+        media_types.append(media_type if media_type else "Text")
+        media_counts.append(count)
+    
+    plt.figure(figsize=(10, 6))
+    plt.bar(media_types, media_counts, color='lightgreen')
+    plt.title('Media Type Distribution')
+    plt.xlabel('Media Type')
+    plt.ylabel('Count')
+    plt.grid(True, linestyle='--', alpha=0.7)
+    plt.xticks(rotation=45)
+    plt.tight_layout()
+    plt.savefig('temp/media_chart.png')
+    plt.close()
+    
+    return {
+        "posts_count": posts_count,
+        "comments_count": comments_count,
+        "messages_count": messages_count,
+        "top_channels": top_channels,
+        "stale_sentiment_count": stale_sentiment_count,
+        "day_activity_chart": "temp/day_activity_chart.png",
+        "sentiment_chart": "temp/sentiment_chart.png",
+        "media_chart": "temp/media_chart.png"
+    }
+
+class Database:
+    """Keeps SQLite off the event loop: queries run on a reader pool, writes on a single writer"""
+    
+    def __init__(self, reader_threads=DB_READER_THREADS):
+        self.read_pool = ThreadPoolExecutor(max_workers=reader_threads, thread_name_prefix="db-read")
+        self.write_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+        self.queue = None
+        self.writer = None
+    
+    def start(self):
+        """Start the writer task on the running event loop"""
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+        if self.writer is None or self.writer.done():
+            self.writer = asyncio.create_task(self.run_writer())
+    
+    async def run_writer(self):
+        """Apply queued writes in order, one transaction at a time"""
+        loop = asyncio.get_event_loop()
+        while True:
+            func, args, future = await self.queue.get()
+            try:
+                result = await loop.run_in_executor(self.write_pool, functools.partial(func, *args))
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+    
+    async def read(self, func, *args):
+        """Run a query helper on the reader pool and return its result"""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.read_pool, functools.partial(func, *args))
+    
+    async def write(self, func, *args):
+        """Queue a helper that changes the database and wait until the writer has applied it"""
+        self.start()
+        future = asyncio.get_event_loop().create_future()
+        await self.queue.put((func, args, future))
+        return await future
+    
+    def pending_writes(self):
+        """Get the number of writes waiting for the writer"""
+        return self.queue.qsize() if self.queue else 0
+
+db = Database()
+
+class KeywordIndex:
+    """Keeps the compiled keyword matcher, rebuilding it only after the keyword list changed"""
+    
+    def __init__(self):
+        self.matcher = None
+        self.version = 0
+    
+    def invalidate(self):
+        """Drop the matcher after a keyword was added or deleted"""
+        self.matcher = None
+        self.version += 1
+    
+    async def get_matcher(self):
+        """Get the current matcher, loading the keywords and compiling it if needed"""
+        if self.matcher is None:
+            version = self.version
+            matcher = await db.read(build_keyword_matcher)
+            # A change made while compiling means this matcher is already out of date
+            if version != self.version:
+                return matcher
+            self.matcher = matcher
+            logger.info(f"Keyword matcher compiled: {len(matcher.keywords)} keywords, {len(matcher.transitions)} states")
+        return self.matcher
+
+def build_keyword_matcher():
+    """Load the keywords and compile them; runs on a database reader thread"""
+    return KeywordMatcher(get_keywords())
+
+keyword_index = KeywordIndex()
+
+async def check_keywords_in_content(content, source_name, content_type, content_date):
+    """Check if content contains any monitored keywords and notify admins"""
+    # Convert content to string in case it's not
+    if content is None:
+        return
+    
+    matcher = await keyword_index.get_matcher()
+    found_keywords = matcher.find(str(content))
+    
+    if found_keywords:
+        # Sending happens in the background so collection never waits for the Bot API
+        notification_dispatcher.notify((found_keywords, content_type, source_name, content_date, str(content)))
+
+def upsert_rows(cursor, table, source_column, columns, update_clause, rows):
+    """Upsert rows keyed by (source, message_id) with one executemany. Returns the keys that were not stored before"""
+    if not rows:
+        return []
+    
+    ids_by_source = {}
+    for source, message_id in rows:
+        ids_by_source.setdefault(source, []).append(message_id)
+    
+    existing = set()
+    for source, message_ids in ids_by_source.items():
+        for i in range(0, len(message_ids), 500):
+            chunk = message_ids[i:i + 500]
+            placeholders = ", ".join("?" for _ in chunk)
+            cursor.execute(
+                f"SELECT message_id FROM {table} WHERE {source_column} = ? AND message_id IN ({placeholders})",
+                (source, *chunk)
+            )
+            existing.update((source, row[0]) for row in cursor.fetchall())
+    
+    cursor.executemany(
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)}) "
+        f"ON CONFLICT({source_column}, message_id) DO UPDATE SET {update_clause}",
+        list(rows.values())
+    )
+    return [key for key in rows if key not in existing]
+
+class IngestBatch:
+    """Rows collected from one source, written in a single transaction"""
+    
+    def __init__(self):
+        # (source, message_id) -> row; a message seen twice keeps its latest version
+        self.posts = {}
+        self.comments = {}
+        self.messages = {}
+        
+        # State committed in the same transaction as the rows
+        self.source_cursor = None  # (source_name, last_message_id)
+        self.discussion_cursor = None  # (channel_name, last_comment_id)
+        self.threads = []  # (channel_name, discussion_message_id, post_message_id)
+        self.reply_counts = []  # (channel_name, message_id, reply_count)
+        self.backfill_checkpoint = None  # (source_name, offset_id, messages_done, completed)
+        
+        # Media to download once the rows are stored
+        self.media = []
+    
+    def __len__(self):
+        return len(self.posts) + len(self.comments) + len(self.messages)
+    
+    def add_message(self, source_name, source_type, message, account):
+        """Add a channel post or group message fetched by an account; messages without text are skipped"""
+        message_date = message.date.strftime("%Y-%m-%d %H:%M:%S")
+        message_content = getattr(message, 'message', None)
+        
+        if not message_content:
+            return
+        
+        media_type = get_media_type(message)
+        if source_type == "channel":
+            self.posts[(source_name, message.id)] = (
+                message_date, source_name, message_content, message.id,
+                getattr(message, 'views', None), getattr(message, 'forwards', None),
+                count_reactions(getattr(message, 'reactions', None)), media_type, int(message.date.timestamp())
+            )
+            job = media_pipeline.make_job("posts", "channel_name", source_name, message, media_type, account)
+        else:  # Group
+            user_id = getattr(message.from_id, 'user_id', None)
+            self.messages[(source_name, message.id)] = (
+                message_date, source_name, message_content, user_id,
+                user_cache.lookup(user_id), media_type, message.id, int(message.date.timestamp())
+            )
+            job = media_pipeline.make_job("messages", "source", source_name, message, media_type, account)
+        
+        if job:
+            self.media.append(job)
+    
+    def add_comment(self, channel_name, post_message_id, comment):
+        """Add a comment on a channel post; the post text is joined in from posts when needed"""
+        comment_date = comment.date.strftime("%Y-%m-%d %H:%M:%S")
+        comment_text = comment.message
+        user_id = getattr(comment.from_id, 'user_id', None)
+        
+        # Sentiment and its lexicon version are filled in for the whole batch by score_sentiments()
+        self.comments[(channel_name, comment.id)] = (
+            comment_date, channel_name, comment_text, user_id,
+            user_cache.lookup(user_id), None, comment.id, post_message_id, None, int(comment.date.timestamp())
+        )
+    
+    async def score_sentiments(self):
+        """Label the sentiment of all comments in one batch on the sentiment pool"""
+        if not self.comments:
+            return
+        
+        keys = list(self.comments)
+        version = sentiment_analyzer.version
+        labels = await asyncio.get_event_loop().run_in_executor(
+            sentiment_pool, classify_sentiments, [self.comments[key][2] for key in keys]
+        )
+        for key, label in zip(keys, labels):
+            row = self.comments[key]
+            self.comments[key] = row[:5] + (label,) + row[6:8] + (version,) + row[9:]
+    
+    def write(self, cursor):
+        """Upsert all rows without committing. Returns (content, source, content_type, date) of new rows"""
+        new_rows = []
+        
+        for key in upsert_rows(cursor, "posts", "channel_name",
+                               ["date", "channel_name", "content", "message_id", "views", "forwards", "reactions",
+                                "media_type", "timestamp"],
+                               "content = excluded.content, views = COALESCE(excluded.views, views), "
+                               "forwards = COALESCE(excluded.forwards, forwards), reactions = COALESCE(excluded.reactions, reactions)",
+                               self.posts):
+            row = self.posts[key]
+            new_rows.append((row[2], row[1], "post", row[0]))
+        
+        for key in upsert_rows(cursor, "comments", "channel_name",
+                               ["date", "channel_name", "comment_text", "user_id", "username",
+                                "sentiment", "message_id", "post_message_id", "sentiment_version", "timestamp"],
+                               "comment_text = excluded.comment_text, sentiment = excluded.sentiment, "
+                               "sentiment_version = excluded.sentiment_version", self.comments):
+            row = self.comments[key]
+            new_rows.append((row[2], row[1], "comment", row[0]))
+        
+        for key in upsert_rows(cursor, "messages", "source",
+                               ["date", "source", "content", "user_id", "username", "media_type", "message_id",
+                                "timestamp"],
+                               "content = excluded.content", self.messages):
+            row = self.messages[key]
+            new_rows.append((row[2], row[1], "message", row[0]))
+        
+        return new_rows
+    
+    def commit(self):
+        """Write the rows and the state that goes with them in one transaction; runs on the database writer"""
+        conn = get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            new_rows = self.write(cursor)
+            for channel_name, discussion_message_id, post_message_id in self.threads:
+                save_discussion_thread(cursor, channel_name, discussion_message_id, post_message_id)
+            for channel_name, message_id, reply_count in self.reply_counts:
+                set_post_reply_count(cursor, channel_name, message_id, reply_count)
+            if self.source_cursor:
+                update_source_cursor(cursor, *self.source_cursor)
+            if self.discussion_cursor:
+                update_discussion_cursor(cursor, *self.discussion_cursor)
+            if self.backfill_checkpoint:
+                save_backfill_checkpoint(cursor, *self.backfill_checkpoint)
+            conn.commit()
+        finally:
+            conn.close()
+        
+        # Cached searches over the period of these rows no longer show everything
+        dates = [row[0] for rows in (self.posts, self.comments, self.messages) for row in rows.values()]
+        if dates:
+            search_cache.bump(min(dates), max(dates))
+        
+        return new_rows
+
+async def alert_new_rows(new_rows):
+    """Check freshly stored rows for monitored keywords"""
+    for content, source_name, content_type, content_date in new_rows:
+        await check_keywords_in_content(content, source_name, content_type, content_date)
+
+class RateLimiter:
+    """Token bucket limiter for one class of Telegram API requests"""
+    
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0
+        self.lock = asyncio.Lock()
+    
+    def pause(self, seconds):
+        """Stop handing out tokens for the given number of seconds"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+    
+    async def acquire(self):
+        """Wait until a request of this class may be sent"""
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+# Errors meaning an account can no longer be used at all
+BANNED_ACCOUNT_ERRORS = (AuthKeyUnregisteredError, UserDeactivatedBanError, UserDeactivatedError)
+
+class Account:
+    """One Telegram session with its own rate limits and throughput counters"""
+    
+    def __init__(self, session_name, api_id, api_hash):
+        self.session_name = session_name
+        self.api_id = api_id
+        self.api_hash = api_hash
+        self.client = None  # Created in start(), so importing the module never opens a session file
+        self.rate_limiters = {request_class: RateLimiter(rate) for request_class, rate in REQUEST_RATE_LIMITS.items()}
+        self.limited_until = 0  # Unix time until which the account's sources go to other accounts
+        self.banned = False
+        self.started_at = time.monotonic()
+        self.requests = 0
+        self.flood_waits = 0
+        self.items = 0
+    
+    async def start(self):
+        """Create the Telethon client and log in"""
+        # FloodWaits are handled by our own rate limiters instead of Telethon's built-in sleep
+        self.client = TelegramClient(self.session_name, self.api_id, self.api_hash, flood_sleep_threshold=0)
+        await self.client.start()
+    
+    def is_available(self):
+        """Check whether the account can take sources right now"""
+        return not self.banned and time.time() >= self.limited_until
+    
+    def stats(self):
+        """Get request and throughput counters"""
+        minutes = (time.monotonic() - self.started_at) / 60
+        if self.banned:
+            state = "banned"
+        elif not self.is_available():
+            state = f"limited for {self.limited_until - time.time():.0f}s"
+        else:
+            state = "ok"
+        return {
+            "state": state,
+            "requests": self.requests,
+            "flood_waits": self.flood_waits,
+            "items": self.items,
+            "items_per_minute": round(self.items / minutes, 1) if minutes else 0,
+        }
+
+def ring_hash(key):
+    """Position of a key on the consistent hash ring"""
+    return int(hashlib.md5(key.encode()).hexdigest()[:16], 16)
+
+class AccountPool:
+    """Assigns sources to accounts by consistent hashing, skipping accounts that are flood-limited or banned"""
+    
+    def __init__(self, accounts, replicas=ACCOUNT_RING_REPLICAS):
+        self.accounts = accounts
+        # Adding or losing an account only moves the sources next to its points on the ring
+        self.ring = sorted(
+            ((ring_hash(f"{account.session_name}#{i}"), account) for account in accounts for i in range(replicas)),
+            key=lambda point: point[0]
+        )
+        self.ring_keys = [key for key, _ in self.ring]
+        self.assignments = {}  # source_name -> session name of the account that handled it last
+    
+    def account_for(self, source_name):
+        """Get the account that should handle a source now"""
+        start = bisect.bisect(self.ring_keys, ring_hash(source_name))
+        for i in range(len(self.ring)):
+            account = self.ring[(start + i) % len(self.ring)][1]
+            if account.is_available():
+                break
+        else:
+            # Every account is limited: use the one that recovers first
+            account = min(self.accounts, key=lambda a: (a.banned, a.limited_until))
+        
+        previous = self.assignments.get(source_name)
+        if previous and previous != account.session_name:
+            logger.info(f"Source {source_name} moved from account {previous} to {account.session_name}")
+        self.assignments[source_name] = account.session_name
+        return account
+    
+    def for_client(self, client):
+        """Get the account a Telethon client belongs to"""
+        for account in self.accounts:
+            if account.client is client:
+                return account
+        return self.accounts[0]
+    
+    def has_available(self, exclude=None):
+        """Check whether any other account can take over sources"""
+        return any(account.is_available() for account in self.accounts if account is not exclude)
+    
+    def stats(self):
+        """Get per-account counters including the number of sources assigned"""
+        stats = {}
+        for account in self.accounts:
+            stats[account.session_name] = account.stats()
+            stats[account.session_name]["sources"] = sum(
+                1 for session_name in self.assignments.values() if session_name == account.session_name
+            )
+        return stats
+
+account_pool = AccountPool([
+    Account(settings["session"], settings["api_id"], settings["api_hash"]) for settings in ACCOUNT_SETTINGS
+])
+
+async def call_telegram(account, request_class, func, *args, **kwargs):
+    """Call the Telegram API within the account's rate limit of the request class, waiting out FloodWaits"""
+    limiter = account.rate_limiters[request_class]
+    
+    for attempt in range(FLOOD_WAIT_RETRIES + 1):
+        await limiter.acquire()
+        account.requests += 1
+        try:
+            return await func(*args, **kwargs)
+        except FloodWaitError as e:
+            account.flood_waits += 1
+            if e.seconds >= ACCOUNT_REBALANCE_FLOOD_WAIT and account_pool.has_available(exclude=account):
+                # Rather than waiting, hand the account's sources to other accounts until the wait is over
+                logger.warning(f"FloodWait of {e.seconds}s on account {account.session_name}, moving its sources")
+                account.limited_until = time.time() + e.seconds
+                limiter.pause(e.seconds)
+                raise
+            if attempt == FLOOD_WAIT_RETRIES:
+                raise
+            # Only this request class is paused, other requests keep going
+            logger.warning(f"FloodWait of {e.seconds}s for '{request_class}' requests on account {account.session_name}")
+            limiter.pause(e.seconds)
+        except BANNED_ACCOUNT_ERRORS as e:
+            logger.error(f"Account {account.session_name} can no longer be used ({e}), moving its sources")
+            account.banned = True
+            raise
+
+async def fetch_new_messages(account, peer, min_id, request_class="history"):
+    """Fetch messages newer than min_id, oldest first"""
+    if not min_id:
+        # First pass over a source: only take the latest page, older history is not collected here
+        history = await call_telegram(account, request_class, account.client, GetHistoryRequest(
+            peer=peer,
+            limit=50,
+            offset_date=None,
+            offset_id=0,
+            max_id=0,
+            min_id=0,
+            add_offset=0,
+            hash=0
+        ))
+        await user_cache.prime(history.users)
+        return sorted(history.messages, key=lambda m: m.id)
+    
+    # Page backwards from the newest message until everything above min_id is fetched
+    messages = []
+    offset_id = 0
+    while True:
+        history = await call_telegram(account, request_class, account.client, GetHistoryRequest(
+            peer=peer,
+            limit=HISTORY_PAGE_SIZE,
+            offset_date=None,
+            offset_id=offset_id,
+            max_id=0,
+            min_id=min_id,
+            add_offset=0,
+            hash=0
+        ))
+        messages.extend(history.messages)
+        await user_cache.prime(history.users)
+        
+        if len(history.messages) < HISTORY_PAGE_SIZE:
+            break
+        offset_id = min(m.id for m in history.messages)
+    
+    return sorted(messages, key=lambda m: m.id)
+
+def get_media_type(message):
+    """Determine the media type of a message"""
+    media_type = None
+    if message.media:
+        if hasattr(message.media, 'photo'):
+            media_type = "photo"
+        elif hasattr(message.media, 'document'):
+            if hasattr(message.media.document, 'mime_type'):
+                if 'video' in message.media.document.mime_type:
+                    media_type = "video"
+                elif 'audio' in message.media.document.mime_type:
+                    media_type = "audio"
+                else:
+                    media_type = "document"
+    return media_type
+
+def count_reactions(reactions):
+    """Get the total number of reactions from a MessageReactions object, None if it is missing"""
+    if reactions is None:
+        return None
+    return sum(result.count for result in getattr(reactions, 'results', None) or [])
+
+def format_username(user):
+    """Get a display name for a Telegram user entity"""
+    return user.username or f"{user.first_name} {user.last_name if user.last_name else ''}"
+
+class UserCache:
+    """LRU cache of user display names backed by the users table"""
+    
+    def __init__(self, capacity=USER_CACHE_SIZE, ttl=USER_CACHE_TTL):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.entries = OrderedDict()  # user_id -> (username, updated_at)
+        self.hits = 0
+        self.db_hits = 0
+        self.misses = 0
+    
+    def remember(self, user_id, username, updated_at):
+        """Put a user in memory, evicting the least recently used ones"""
+        self.entries[user_id] = (username, updated_at)
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+    
+    def lookup(self, user_id):
+        """Get a name that is already in memory, without database or network access"""
+        entry = self.entries.get(user_id)
+        return entry[0] if entry else None
+    
+    async def store(self, names):
+        """Keep resolved {user_id: username} in memory and in the database"""
+        if not names:
+            return
+        
+        now = time.time()
+        for user_id, username in names.items():
+            self.remember(user_id, username, now)
+        
+        await db.write(self.save_to_db, [(user_id, username, now) for user_id, username in names.items()])
+    
+    async def prime(self, users):
+        """Cache user entities that came along with an API response"""
+        await self.store({user.id: format_username(user) for user in users if not getattr(user, 'min', False)})
+    
+    def save_to_db(self, rows):
+        """Store (user_id, username, updated_at) rows in the users table"""
+        conn = get_connection()
+        conn.executemany(
+            "INSERT OR REPLACE INTO users (user_id, username, updated_at) VALUES (?, ?, ?)",
+            rows
+        )
+        conn.commit()
+        conn.close()
+    
+    def load_from_db(self, user_ids):
+        """Get fresh names of the given users from the users table"""
+        conn = get_connection()
+        cursor = conn.cursor()
+        
+        placeholders = ", ".join("?" for _ in user_ids)
+        cursor.execute(
+            f"SELECT user_id, username, updated_at FROM users WHERE user_id IN ({placeholders}) AND updated_at >= ?",
+            (*user_ids, time.time() - self.ttl)
+        )
+        rows = cursor.fetchall()
+        
+        conn.close()
+        return rows
+    
+    async def resolve(self, user_ids, account):
+        """Get {user_id: username} for the given users, asking Telegram through the account only for unknown ones"""
+        names = {}
+        missing = []
+        now = time.time()
+        
+        for user_id in set(user_ids):
+            entry = self.entries.get(user_id)
+            if entry and now - entry[1] < self.ttl:
+                self.entries.move_to_end(user_id)
+                names[user_id] = entry[0]
+                self.hits += 1
+            else:
+                missing.append(user_id)
+        
+        if missing:
+            for user_id, username, updated_at in await db.read(self.load_from_db, missing):
+                self.remember(user_id, username, updated_at)
+                names[user_id] = username
+                self.db_hits += 1
+            missing = [user_id for user_id in missing if user_id not in names]
+        
+        if missing:
+            self.misses += len(missing)
+            resolved = {}
+            try:
+                # One request for the whole batch
+                users = await call_telegram(account, "entity", account.client.get_entity, missing)
+                resolved = {user.id: format_username(user) for user in users}
+            except Exception:
+                # Some ids could not be resolved, fall back to looking them up one by one
+                for user_id in missing:
+                    try:
+                        user = await call_telegram(account, "entity", account.client.get_entity, user_id)
+                        resolved[user.id] = format_username(user)
+                    except Exception:
+                        pass
+            
+            await self.store(resolved)
+            names.update(resolved)
+        
+        return names
+    
+    def stats(self):
+        """Get hit/miss counters"""
+        lookups = self.hits + self.db_hits + self.misses
+        hit_ratio = (self.hits + self.db_hits) / lookups if lookups else 0
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "db_hits": self.db_hits,
+            "misses": self.misses,
+            "hit_ratio": hit_ratio,
+        }
+
+user_cache = UserCache()
+
+class MediaPipeline:
+    """Downloads media of stored messages in the background, keeping one file per unique content"""
+    
+    def __init__(self, concurrency=MEDIA_DOWNLOAD_CONCURRENCY, queue_size=MEDIA_QUEUE_SIZE):
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.queue = None  # Created by start(); nothing is queued while the pipeline is off
+        self.workers = []
+        self.downloaded = 0
+        self.deduplicated = 0
+        self.skipped = 0
+        self.dropped = 0
+    
+    def start(self):
+        """Start the download workers on the running event loop"""
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self.workers = [asyncio.create_task(self.run_worker()) for _ in range(self.concurrency)]
+    
+    def make_job(self, table, source_column, source, message, media_type, account):
+        """Describe the download of a message's media, or None if it should not be downloaded"""
+        if self.queue is None or media_type not in MEDIA_SIZE_LIMITS:
+            return None
+        
+        # Photo and document ids stay the same when a post is forwarded to other channels
+        media = getattr(message.media, media_type if media_type == "photo" else "document", None)
+        size = getattr(getattr(message, 'file', None), 'size', None) or 0
+        if media is None or size > MEDIA_SIZE_LIMITS[media_type]:
+            self.skipped += 1
+            return None
+        
+        file_key = f"{media_type}:{media.id}"
+        return table, source_column, source, message.id, media_type, file_key, message, account
+    
+    def submit(self, jobs):
+        """Queue downloads without waiting; when the queue is full they are dropped"""
+        for job in jobs:
+            try:
+                self.queue.put_nowait(job)
+            except asyncio.QueueFull:
+                self.dropped += 1
+    
+    async def run_worker(self):
+        """Process queued downloads forever"""
+        while True:
+            job = await self.queue.get()
+            try:
+                await self.download(*job)
+            except Exception as e:
+                logger.error(f"Error downloading media of {job[2]}, message {job[3]}: {e}")
+            finally:
+                self.queue.task_done()
+    
+    async def download(self, table, source_column, source, message_id, media_type, file_key, message, account):
+        """Download one file unless the same media was stored before, and link it to its row"""
+        file_hash = await db.read(get_media_hash, file_key)
+        if file_hash:
+            self.deduplicated += 1
+            await db.write(save_media, table, source_column, source, message_id, file_key, file_hash)
+            return
+        
+        # File references are only valid for the session that fetched the message
+        data = await call_telegram(account, "media", account.client.download_media, message, file=bytes)
+        if not data:
+            return
+        
+        file_hash = hashlib.sha256(data).hexdigest()
+        extension = getattr(getattr(message, 'file', None), 'ext', None) or ""
+        path = os.path.join(MEDIA_DIR, file_hash[:2], file_hash[2:4], file_hash + extension)
+        await asyncio.get_event_loop().run_in_executor(None, write_media_file, path, data)
+        
+        self.downloaded += 1
+        await db.write(save_media, table, source_column, source, message_id, file_key, file_hash,
+                       path, media_type, len(data))
+    
+    def stats(self):
+        """Get download counters"""
+        return {
+            "queued": self.queue.qsize() if self.queue else 0,
+            "downloaded": self.downloaded,
+            "deduplicated": self.deduplicated,
+            "skipped": self.skipped,
+            "dropped": self.dropped,
+        }
+
+def write_media_file(path, data):
+    """Write a media file unless a file with the same content already exists"""
+    if os.path.exists(path):
+        return
+    
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    
+    # Write under a temporary name so a crash never leaves a truncated file behind
+    temp_path = f"{path}.part"
+    with open(temp_path, 'wb') as file:
+        file.write(data)
+    os.replace(temp_path, path)
+
+media_pipeline = MediaPipeline()
+
+def format_alert(alert, markdown=True):
+    """Format a single keyword alert, as MarkdownV2 or as plain text"""
+    bold, quote = (md.bold, md.escape_md) if markdown else (str, str)
+    found_keywords, content_type, source_name, content_date, content = alert
+    notification = f"🔍 {bold('Обнаружены ключевые слова:')} {quote(', '.join(found_keywords))}\n\n"
+    notification += f"📂 {bold('Тип контента:')} {quote(content_type)}\n"
+    notification += f"📢 {bold('Источник:')} {quote(source_name)}\n"
+    notification += f"📅 {bold('Дата:')} {quote(content_date)}\n\n"
+    notification += f"💬 {bold('Содержание:')}\n{quote(content[:200] + '...')}"
+    return notification
+
+def format_digest(alerts, markdown=True):
+    """Format several keyword alerts as one message, as MarkdownV2 or as plain text"""
+    bold, quote = (md.bold, md.escape_md) if markdown else (str, str)
+    notification = f"🔍 {bold(f'Обнаружены ключевые слова: {len(alerts)} совпадений')}\n\n"
+    for i, (found_keywords, content_type, source_name, content_date, content) in enumerate(
+            alerts[:NOTIFY_DIGEST_MAX_ITEMS], 1):
+        notification += f"{quote(f'{i}.')} {bold(', '.join(found_keywords))} "
+        notification += f"{quote(f'— {source_name} ({content_type}, {content_date})')}\n"
+        notification += f"{quote(content[:100] + '...')}\n\n"
+    if len(alerts) > NOTIFY_DIGEST_MAX_ITEMS:
+        notification += quote(f"…и ещё {len(alerts) - NOTIFY_DIGEST_MAX_ITEMS}")
+    return notification
+
+class NotificationDispatcher:
+    """Sends keyword alerts to admins in the background, merging bursts into digests within the Bot API limits"""
+    
+    def __init__(self, window=NOTIFY_DIGEST_WINDOW):
+        self.window = window
+        self.queue = None
+        self.pending = {}  # admin_id -> alerts waiting for the next message
+        self.last_sent = {}  # admin_id -> unix time of the last message
+        self.global_limiter = RateLimiter(NOTIFY_GLOBAL_RATE)
+        self.chat_limiters = {}
+        self.sent = 0
+        self.merged = 0
+        self.failed = 0
+    
+    def start(self):
+        """Start the dispatcher task on the running event loop"""
+        self.queue = asyncio.Queue()
+        asyncio.create_task(self.run())
+    
+    def notify(self, alert):
+        """Queue a (keywords, content_type, source, date, content) alert without waiting"""
+        if self.queue is None:
+            logger.warning(f"Notification dispatcher is not running, alert from {alert[2]} dropped")
+            return
+        self.queue.put_nowait(alert)
+    
+    async def run(self):
+        """Hand queued alerts to every admin, scheduling one send per burst"""
+        while True:
+            alert = await self.queue.get()
+            for admin_id in ADMIN_IDS:
+                pending = self.pending.setdefault(admin_id, [])
+                pending.append(alert)
+                if len(pending) == 1:
+                    asyncio.create_task(self.flush(admin_id))
+    
+    async def flush(self, admin_id):
+        """Send what is pending for an admin once the digest window since the last message has passed"""
+        # The first alert after a quiet period goes out at once, later ones wait and are merged
+        delay = self.last_sent.get(admin_id, 0) + self.window - time.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        
+        alerts = self.pending.pop(admin_id, [])
+        if not alerts:
+            return
+        
+        self.merged += len(alerts) - 1
+        format_alerts = format_alert if len(alerts) == 1 else format_digest
+        content = alerts[0] if len(alerts) == 1 else alerts
+        self.last_sent[admin_id] = time.time()
+        await self.send(admin_id, format_alerts(content), format_alerts(content, markdown=False))
+    
+    async def send(self, chat_id, text, plain_text):
+        """Send a message within the global and per-chat limits, retrying after 429 responses"""
+        parse_mode = ParseMode.MARKDOWN_V2
+        limiter = self.chat_limiters.get(chat_id)
+        if limiter is None:
+            limiter = self.chat_limiters[chat_id] = RateLimiter(NOTIFY_CHAT_RATE)
+        
+        for attempt in range(NOTIFY_RETRIES + 1):
+            await limiter.acquire()
+            await self.global_limiter.acquire()
+            try:
+                await bot.send_message(chat_id, text, parse_mode=parse_mode)
+                self.sent += 1
+                return
+            except RetryAfter as e:
+                logger.warning(f"Bot API asked to wait {e.timeout}s before notifying admin {chat_id}")
+                limiter.pause(e.timeout)
+                self.global_limiter.pause(e.timeout)
+            except BadRequest as e:
+                if parse_mode is None:
+                    logger.error(f"Failed to send notification to admin {chat_id}: {e}")
+                    break
+                # A digest the API cannot parse is sent without formatting rather than lost with all its alerts
+                logger.warning(f"Notification to admin {chat_id} was rejected ({e}), sending it as plain text")
+                text, parse_mode = plain_text, None
+            except Exception as e:
+                logger.error(f"Failed to send notification to admin {chat_id}: {e}")
+                break
+        
+        self.failed += 1
+    
+    def stats(self):
+        """Get dispatcher counters"""
+        return {
+            "queued": self.queue.qsize() if self.queue else 0,
+            "pending": sum(len(alerts) for alerts in self.pending.values()),
+            "sent": self.sent,
+            "merged": self.merged,
+            "failed": self.failed,
+        }
+
+notification_dispatcher = NotificationDispatcher()
+
+async def get_discussion_group(account, channel_name, peer):
+    """Get (discussion_id, last_comment_id) of a channel's linked group, or None if it has no comments"""
+    cached = await db.read(get_channel_discussion, channel_name)
+    if cached and time.time() - cached[2] < DISCUSSION_CHECK_INTERVAL:
+        discussion_id, last_comment_id, _ = cached
+    else:
+        full = await call_telegram(account, "entity", account.client, GetFullChannelRequest(peer))
+        discussion_id = full.full_chat.linked_chat_id
+        await db.write(save_channel_discussion, channel_name, discussion_id)
+        last_comment_id = cached[1] if cached and cached[0] == discussion_id else 0
+    
+    if not discussion_id:
+        return None
+    return discussion_id, last_comment_id
+
+async def collect_comments(account, channel_name, channel_peer):
+    """Collect new comments of a channel from its discussion group. Returns the number of new comments"""
+    discussion = await get_discussion_group(account, channel_name, channel_peer)
+    if not discussion:
+        return 0
+    
+    discussion_id, last_comment_id = discussion
+    peer = PeerChannel(discussion_id)
+    
+    # The discussion group is read incrementally like any other source
+    messages = await fetch_new_messages(account, peer, last_comment_id, request_class="comments")
+    
+    batch = IngestBatch()
+    comments = []
+    for message in messages:
+        fwd_from = getattr(message, 'fwd_from', None)
+        if fwd_from and getattr(fwd_from, 'channel_post', None):
+            # Copy of a channel post that starts a comment thread
+            batch.threads.append((channel_name, message.id, fwd_from.channel_post))
+        elif getattr(message, 'message', None) and getattr(message, 'reply_to', None):
+            thread_id = message.reply_to.reply_to_top_id or message.reply_to.reply_to_msg_id
+            comments.append((thread_id, message))
+    
+    # Threads started before the cursor are looked up in one batched request
+    thread_ids = list({thread_id for thread_id, _ in comments})
+    thread_posts = {discussion_message_id: post_message_id for _, discussion_message_id, post_message_id in batch.threads}
+    thread_posts.update(await db.read(get_thread_posts, channel_name,
+                                      [thread_id for thread_id in thread_ids if thread_id not in thread_posts]))
+    unknown_ids = [thread_id for thread_id in thread_ids if thread_id not in thread_posts]
+    if unknown_ids:
+        for message in await call_telegram(account, "comments", account.client.get_messages, peer, ids=unknown_ids):
+            fwd_from = getattr(message, 'fwd_from', None) if message else None
+            if fwd_from and getattr(fwd_from, 'channel_post', None):
+                batch.threads.append((channel_name, message.id, fwd_from.channel_post))
+                thread_posts[message.id] = fwd_from.channel_post
+    
+    # Resolve all commenters at once so storing comments needs no lookups
+    commenter_ids = [getattr(comment.from_id, 'user_id', None) for _, comment in comments]
+    await user_cache.resolve([user_id for user_id in commenter_ids if user_id], account)
+    
+    for thread_id, comment in comments:
+        post_message_id = thread_posts.get(thread_id)
+        if post_message_id is None:
+            continue  # Reply to a message that is not a channel post
+        batch.add_comment(channel_name, post_message_id, comment)
+    
+    if messages:
+        batch.discussion_cursor = (channel_name, messages[-1].id)
+    await batch.score_sentiments()
+    new_rows = await db.write(batch.commit)
+    
+    await alert_new_rows(new_rows)
+    return len(new_rows)
+
+async def refresh_reply_threads(account, channel_name, channel_peer, reply_counts):
+    """Re-read threads of posts whose reply counter changed and still lacks comments. Returns the number of new comments"""
+    # Normally the discussion group cursor has already delivered every comment,
+    # so this only fetches threads that started before the cursor
+    states = await db.read(get_post_reply_states, channel_name, list(reply_counts))
+    batch = IngestBatch()
+    
+    for message_id, reply_count in reply_counts.items():
+        if message_id not in states:
+            continue
+        
+        stored_count, stored_comments, newest_comment_id = states[message_id]
+        if reply_count == stored_count:
+            continue
+        
+        batch.reply_counts.append((channel_name, message_id, reply_count))
+        if stored_comments >= reply_count:
+            continue
+        
+        try:
+            comments = await call_telegram(
+                account,
+                "comments",
+                account.client.get_messages,
+                entity=channel_peer,
+                reply_to=message_id,
+                min_id=newest_comment_id or 0,
+                limit=100
+            )
+            
+            commenter_ids = [getattr(comment.from_id, 'user_id', None) for comment in comments]
+            await user_cache.resolve([user_id for user_id in commenter_ids if user_id], account)
+            
+            for comment in comments:
+                if comment.message:
+                    batch.add_comment(channel_name, message_id, comment)
+        except Exception as e:
+            logger.error(f"Error getting comments for {channel_name}, message {message_id}: {e}")
+    
+    await batch.score_sentiments()
+    new_rows = await db.write(batch.commit)
     
-    # Comment sentiment distribution
-    cursor.execute(
-        "SELECT sentiment, COUNT(*) as count FROM comments GROUP BY sentiment"
-    )
-    sentiment_distribution = cursor.fetchall()
+    await alert_new_rows(new_rows)
+    return len(new_rows)
+
+source_peer_cache = {}  # (session_name, source_name) -> input peer
+
+# Errors meaning a cached peer no longer works and the source has to be resolved again
+STALE_PEER_ERRORS = (ChannelInvalidError, ChannelPrivateError, PeerIdInvalidError)
+
+async def get_source_peer(source_name, account):
+    """Get the input peer of a source for an account, resolving and joining it only when nothing is cached"""
+    # Access hashes differ between sessions, so every account resolves and joins on its own
+    cache_key = (account.session_name, source_name)
+    peer = source_peer_cache.get(cache_key)
+    if peer:
+        return peer
+    
+    row = await db.read(load_source_peer, account.session_name, source_name)
+    if row and row[3]:
+        peer_type, peer_id, access_hash, _ = row
+        if peer_type == "channel":
+            peer = InputPeerChannel(peer_id, access_hash)
+        elif peer_type == "chat":
+            peer = InputPeerChat(peer_id)
+        else:
+            peer = InputPeerUser(peer_id, access_hash)
+        source_peer_cache[cache_key] = peer
+        return peer
+    
+    # Join the channel/group if not joined already
+    entity = await call_telegram(account, "entity", account.client.get_entity, source_name)
+    if hasattr(entity, 'megagroup') and getattr(entity, 'left', True):
+        await call_telegram(account, "join", account.client, JoinChannelRequest(entity))
+    
+    peer = utils.get_input_peer(entity)
+    session_name = account.session_name
+    if isinstance(peer, InputPeerChannel):
+        await db.write(save_source_peer, session_name, source_name, "channel", peer.channel_id, peer.access_hash, True)
+    elif isinstance(peer, InputPeerChat):
+        await db.write(save_source_peer, session_name, source_name, "chat", peer.chat_id, None, True)
+    elif isinstance(peer, InputPeerUser):
+        await db.write(save_source_peer, session_name, source_name, "user", peer.user_id, peer.access_hash, True)
+    
+    source_peer_cache[cache_key] = peer
+    return peer
+
+async def invalidate_source_peer(source_name, account=None):
+    """Forget the cached peer of a source for one account, or for all of them, so it is resolved and joined again"""
+    for session_name, name in list(source_peer_cache):
+        if name == source_name and (account is None or session_name == account.session_name):
+            del source_peer_cache[(session_name, name)]
+    await db.write(delete_source_peer, source_name, account.session_name if account else None)
+
+async def collect_source(source_name, source_type):
+    """Collect new content from a single source. Returns the number of new items stored"""
+    new_items = 0
+    generation = live_ingestion.generation
+    account = account_pool.account_for(source_name)
     
-    # Media type distribution
-    cursor.execute(
-        "SELECT media_type, COUNT(*) as count FROM messages WHERE media_type IS NOT NULL GROUP BY media_type"
-    )
-    media_distribution = cursor.fetchall()
+    try:
+        try:
+            peer = await get_source_peer(source_name, account)
+        except ChannelPrivateError:
+            logger.error(f"Cannot join private channel/group: {source_name}")
+            return new_items
+        except Exception as e:
+            logger.error(f"Error joining channel/group {source_name}: {e}")
+            return new_items
+        
+        # Get messages newer than the last one collected
+        last_message_id = await db.read(get_source_cursor, source_name)
+        try:
+            messages = await fetch_new_messages(account, peer, last_message_id)
+        except STALE_PEER_ERRORS as e:
+            logger.warning(f"Cached peer of {source_name} is stale ({e}), resolving it again")
+            await invalidate_source_peer(source_name, account)
+            peer = await get_source_peer(source_name, account)
+            messages = await fetch_new_messages(account, peer, last_message_id)
+        
+        if source_type != "channel":
+            sender_ids = [getattr(getattr(message, 'from_id', None), 'user_id', None) for message in messages]
+            await user_cache.resolve([user_id for user_id in sender_ids if user_id], account)
+        
+        batch = IngestBatch()
+        for message in messages:
+            batch.add_message(source_name, source_type, message, account)
+        
+        # Remember how far we got, including messages without text
+        if messages:
+            batch.source_cursor = (source_name, messages[-1].id)
+        new_rows = await db.write(batch.commit)
+        media_pipeline.submit(batch.media)
+        
+        await alert_new_rows(new_rows)
+        new_items += len(new_rows)
+        
+        # Get comments if the channel has a discussion group
+        if source_type == "channel":
+            try:
+                new_items += await collect_comments(account, source_name, peer)
+                
+                reply_counts = {
+                    message.id: message.replies.replies
+                    for message in messages
+                    if getattr(message, 'message', None) and getattr(message, 'replies', None)
+                }
+                new_items += await refresh_reply_threads(account, source_name, peer, reply_counts)
+            except Exception as e:
+                logger.error(f"Error getting comments for {source_name}: {e}")
+        
+        live_ingestion.mark_reconciled(source_name, generation)
+    except Exception as e:
+        logger.error(f"Error collecting content from {source_name}: {e}")
     
-    conn.close()
+    account.items += new_items
+    return new_items
+
+async def shutdown_process_pool(pool):
+    """Wait for a process pool's workers to exit on a thread, so the event loop keeps running meanwhile"""
+    await asyncio.get_event_loop().run_in_executor(None, pool.shutdown)
+
+async def run_in_process_pool(read_chunks, worker, initializer, initargs, write_results, report_progress):
+    """Run worker(*args) on a process pool for every args tuple read_chunks yields, writing results in order"""
+    loop = asyncio.get_event_loop()
+    chunks = read_chunks.__aiter__()
+    exhausted = False
+    in_flight = deque()  # (args, future) in the order the chunks were read
+    started_at = time.monotonic()
+    reported_at = started_at
+    
+    pool = ProcessPoolExecutor(max_workers=SCAN_WORKERS, mp_context=SCAN_PROCESS_CONTEXT,
+                               initializer=initializer, initargs=initargs)
+    try:
+        while True:
+            if not exhausted:
+                try:
+                    args = await chunks.__anext__()
+                    in_flight.append((args, loop.run_in_executor(pool, worker, *args)))
+                except StopAsyncIteration:
+                    exhausted = True
+            
+            # Keep two chunks per worker queued so reading never leaves a core idle
+            if in_flight and (len(in_flight) >= SCAN_WORKERS * 2 or exhausted):
+                args, future = in_flight.popleft()
+                await write_results(args, await future)
+            
+            if exhausted and not in_flight:
+                break
+            
+            if time.monotonic() - reported_at >= SCAN_PROGRESS_INTERVAL:
+                reported_at = time.monotonic()
+                try:
+                    await report_progress(reported_at - started_at)
+                except Exception as e:
+                    logger.warning(f"Cannot report progress of {worker.__name__}: {e}")
+    finally:
+        await shutdown_process_pool(pool)
     
-    # Create charts
-    # Day of week activity chart
-    days = ["Sun", "Mon", "Tue", "Wed", "Thu", "Fri", "Sat"]
-    counts = [0] * 7
-    for day, count in posts_by_day:
-        counts[int(day)] = count
+    return time.monotonic() - started_at
+
+scan_lock = asyncio.Lock()
+
+async def scan_keyword_history(keywords, chat_id):
+    """Match keywords against all stored content on a process pool, reporting progress to an admin"""
+    totals = {table: await db.read(count_rows, table) for table in SCAN_TABLES}
+    total = sum(totals.values())
+    scanned = 0
+    hit_counts = {}
+    
+    progress = await bot.send_message(chat_id, f"🔎 Проверка истории: 0 из {total} записей...")
+    
+    async def read_chunks():
+        for table, (content_type, _, _) in SCAN_TABLES.items():
+            after_id = 0
+            while True:
+                rows = await db.read(get_scan_chunk, table, after_id, SCAN_CHUNK_SIZE)
+                if not rows:
+                    break
+                after_id = rows[-1][0]
+                yield content_type, rows
+    
+    async def write_hits(args, hits):
+        nonlocal scanned
+        if hits:
+            await db.write(save_keyword_hits, hits)
+        for hit in hits:
+            hit_counts[hit[0]] = hit_counts.get(hit[0], 0) + 1
+        scanned += len(args[1])
+    
+    async def report_progress(elapsed):
+        await bot.edit_message_text(
+            f"🔎 Проверка истории: {scanned} из {total} записей ({scanned / elapsed:.0f} в секунду), "
+            f"найдено совпадений: {sum(hit_counts.values())}...",
+            chat_id, progress.message_id
+        )
     
-    plt.figure(figsize=(10, 6))
-    plt.bar(days, counts, color='skyblue')
-    plt.title('Activity by Day of Week')
-    plt.xlabel('Day')
-    plt.ylabel('Number of Posts')
-    plt.grid(True, linestyle='--', alpha=0.7)
-    plt.savefig('temp/day_activity_chart.png')
-    plt.close()
+    elapsed = await run_in_process_pool(read_chunks(), scan_rows, init_scan_worker, (keywords,),
+                                        write_hits, report_progress)
+    logger.info(f"Keyword scan of {len(keywords)} keywords finished: {scanned} rows, "
+                f"{sum(hit_counts.values())} hits in {elapsed:.1f}s on {SCAN_WORKERS} workers")
     
-    # Sentiment distribution chart
-    sentiments = []
-    sentiment_counts = []
-    for sentiment, count in sentiment_distribution:
-        sentiments.append(sentiment)
-        sentiment_counts.append(count)
+    result_text = f"✅ Проверка истории завершена: {scanned} записей за {elapsed:.0f} с.\n\n"
+    if hit_counts:
+        result_text += "Найдено совпадений:\n"
+        for keyword, count in sorted(hit_counts.items(), key=lambda item: -item[1])[:30]:
+            result_text += f"• {keyword}: {count}\n"
+    else:
+        result_text += "Совпадений не найдено."
+    await bot.send_message(chat_id, result_text)
+
+async def run_keyword_scan(keywords, chat_id):
+    """Run one keyword scan at a time, reporting failures to the admin"""
+    async with scan_lock:
+        try:
+            await scan_keyword_history(keywords, chat_id)
+        except Exception as e:
+            logger.error(f"Keyword scan failed: {e}")
+            await bot.send_message(chat_id, f"❌ Проверка истории прервана: {e}")
+
+rescore_lock = asyncio.Lock()
+
+async def rescore_sentiments(chat_id):
+    """Re-label comments scored by another lexicon version on a process pool, reporting progress to an admin"""
+    global sentiment_analyzer
     
-    plt.figure(figsize=(8, 8))
-    colors = ['green', 'red', 'gray']
-    plt.pie(sentiment_counts, labels=sentiments, autopct='%1.1f%%', startangle=140, colors=colors)
-    plt.axis('equal')
-    plt.title('Comment Sentiment Distribution')
-    plt.savefig('temp/sentiment_chart.png')
-    plt.close()
+    # Pick up edits of the lexicon file; new comments are scored with it from here on
+    sentiment_analyzer = SentimentAnalyzer.load()
+    version = sentiment_analyzer.version
     
-    # Media type distribution chart
-    media_types = []
-    media_counts = []
-    for media_type, count in media_distribution:
-        media_types.append(media_type if media_type else "Text")
-        media_counts.append(count)
+    total = await db.read(count_stale_sentiments, version)
+    if not total:
+        await bot.send_message(chat_id, f"✅ Тональность всех комментариев уже рассчитана по текущему словарю ({version}).")
+        return
     
-    plt.figure(figsize=(10, 6))
-    plt.bar(media_types, media_counts, color='lightgreen')
-    plt.title('Media Type Distribution')
-    plt.xlabel('Media Type')
-    plt.ylabel('Count')
-    plt.grid(True, linestyle='--', alpha=0.7)
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-    plt.savefig('temp/media_chart.png')
-    plt.close()
+    rescored = 0
+    progress = await bot.send_message(chat_id, f"🔄 Пересчёт тональности: 0 из {total} комментариев...")
+    
+    async def read_chunks():
+        after_id = 0
+        while True:
+            rows = await db.read(get_stale_sentiment_chunk, version, after_id, SCAN_CHUNK_SIZE)
+            if not rows:
+                break
+            after_id = rows[-1][0]
+            yield (rows,)
+    
+    # Every chunk is written with its version, so an interrupted run continues where it stopped
+    async def write_labels(_, labels):
+        nonlocal rescored
+        await db.write(save_sentiments, version, labels)
+        rescored += len(labels)
+    
+    async def report_progress(elapsed):
+        await bot.edit_message_text(
+            f"🔄 Пересчёт тональности: {rescored} из {total} комментариев ({rescored / elapsed:.0f} в секунду)...",
+            chat_id, progress.message_id
+        )
     
-    return {
-        "posts_count": posts_count,
-        "comments_count": comments_count,
-        "messages_count": messages_count,
-        "top_channels": top_channels,
-        "day_activity_chart": "temp/day_activity_chart.png",
-        "sentiment_chart": "temp/sentiment_chart.png",
-        "media_chart": "temp/media_chart.png"
-    }
+    elapsed = await run_in_process_pool(read_chunks(), rescore_rows, init_sentiment_worker,
+                                        (sentiment_analyzer.lexicon,), write_labels, report_progress)
+    logger.info(f"Sentiment re-score to lexicon {version} finished: {rescored} comments "
+                f"in {elapsed:.1f}s on {SCAN_WORKERS} workers")
+    await bot.send_message(
+        chat_id, f"✅ Пересчёт тональности завершён: {rescored} комментариев за {elapsed:.0f} с. (словарь {version})."
+    )
 
-async def check_keywords_in_content(content, source_name, content_type, content_date):
-    """Check if content contains any monitored keywords and notify admins"""
-    keywords = get_keywords()
-    
-    # Convert content to string in case it's not
-    if content is None:
+async def run_sentiment_rescore(chat_id):
+    """Run one sentiment re-score at a time, reporting failures to the admin"""
+    async with rescore_lock:
+        try:
+            await rescore_sentiments(chat_id)
+        except Exception as e:
+            logger.error(f"Sentiment re-score failed: {e}")
+            await bot.send_message(chat_id, f"❌ Пересчёт тональности прерван: {e}")
+
+backfill_semaphore = asyncio.Semaphore(BACKFILL_CONCURRENCY)
+backfill_tasks = {}
+
+async def backfill_source(source_name, source_type):
+    """Page backwards through the whole history of a source, resuming from its checkpoint"""
+    async with backfill_semaphore:
+        offset_id, messages_done, completed = await db.read(get_backfill_checkpoint, source_name)
+        if completed:
+            return
+        
+        logger.info(f"Backfill of {source_name} started at offset {offset_id} ({messages_done} messages done)")
+        started_at = time.monotonic()
+        fetched = 0
+        
+        try:
+            while True:
+                # Picked per page, so a flood-limited account hands the rest of the backfill over
+                account = account_pool.account_for(source_name)
+                peer = await get_source_peer(source_name, account)
+                history = await call_telegram(account, "backfill", account.client, GetHistoryRequest(
+                    peer=peer,
+                    limit=HISTORY_PAGE_SIZE,
+                    offset_date=None,
+                    offset_id=offset_id,
+                    max_id=0,
+                    min_id=0,
+                    add_offset=0,
+                    hash=0
+                ))
+                
+                if not history.messages:
+                    batch = IngestBatch()
+                    batch.backfill_checkpoint = (source_name, offset_id, messages_done, True)
+                    await db.write(batch.commit)
+                    break
+                
+                # Senders come with the page, so no per-message user lookups are needed
+                await user_cache.prime(history.users)
+                batch = IngestBatch()
+                for message in history.messages:
+                    batch.add_message(source_name, source_type, message, account)
+                
+                offset_id = min(m.id for m in history.messages)
+                messages_done += len(history.messages)
+                fetched += len(history.messages)
+                
+                # The page and its checkpoint are committed in one transaction
+                batch.backfill_checkpoint = (source_name, offset_id, messages_done, False)
+                await db.write(batch.commit)
+                media_pipeline.submit(batch.media)
+                
+                elapsed = time.monotonic() - started_at
+                total = getattr(history, 'count', None) or '?'
+                logger.info(
+                    f"Backfill of {source_name}: {messages_done}/{total} messages, "
+                    f"{fetched / elapsed:.1f} msg/s"
+                )
+                
+                await asyncio.sleep(BACKFILL_PAGE_DELAY)
+            
+            logger.info(f"Backfill of {source_name} finished: {messages_done} messages")
+        except Exception as e:
+            logger.error(f"Backfill of {source_name} stopped at offset {offset_id}: {e}")
+
+async def start_backfill(source_name, source_type):
+    """Run a backfill of a source in the background unless one is already running"""
+    task = backfill_tasks.get(source_name)
+    if task and not task.done():
         return
     
-    content_str = str(content).lower()
-    
-    found_keywords = [keyword for keyword in keywords if keyword.lower() in content_str]
-    
-    if found_keywords:
-        # Create notification message
-        notification = f"🔍 *Обнаружены ключевые слова:* {', '.join(found_keywords)}\n\n"
-        notification += f"📂 *Тип контента:* {content_type}\n"
-        notification += f"📢 *Источник:* {source_name}\n"
-        notification += f"📅 *Дата:* {content_date}\n\n"
-        notification += f"💬 *Содержание:*\n{content[:200]}..."
-        
-        # Send notification to all admins
-        for admin_id in ADMIN_IDS:
+    await db.write(create_backfill_checkpoint, source_name)
+    backfill_tasks[source_name] = asyncio.create_task(backfill_source(source_name, source_type))
+
+async def refresh_channel_metrics(channel_name):
+    """Snapshot views, forwards and reactions of a channel's recent posts. Returns the number of posts refreshed"""
+    since = int(time.time()) - METRICS_WINDOW_DAYS * 24 * 60 * 60
+    message_ids = await db.read(get_recent_post_ids, channel_name, since)
+    if not message_ids:
+        return 0
+    
+    account = account_pool.account_for(channel_name)
+    peer = await get_source_peer(channel_name, account)
+    collected_at = time.time()
+    rows = []
+    
+    for i in range(0, len(message_ids), METRICS_BATCH_SIZE):
+        chunk = message_ids[i:i + METRICS_BATCH_SIZE]
+        
+        # Counters only, so whole messages are never downloaded again
+        result = await call_telegram(account, "metrics", account.client,
+                                     GetMessagesViewsRequest(peer=peer, id=chunk, increment=False))
+        updates = await call_telegram(account, "metrics", account.client, GetMessagesReactionsRequest(peer=peer, id=chunk))
+        reactions = {
+            update.msg_id: count_reactions(update.reactions)
+            for update in getattr(updates, 'updates', [])
+            if isinstance(update, UpdateMessageReactions)
+        }
+        
+        # Views come back in the order of the requested ids
+        for message_id, counters in zip(chunk, result.views):
+            replies = counters.replies.replies if counters.replies else None
+            rows.append((channel_name, message_id, collected_at, counters.views, counters.forwards,
+                         reactions.get(message_id) or 0, replies))
+    
+    await db.write(save_post_metrics, rows)
+    return len(rows)
+
+async def run_metrics_refresh():
+    """Refresh engagement of recent posts of every monitored channel forever"""
+    while True:
+        await asyncio.sleep(METRICS_REFRESH_INTERVAL)
+        started_at = time.monotonic()
+        refreshed = 0
+        
+        for source_name, source_type in await db.read(get_sources):
+            if source_type != "channel":
+                continue
             try:
-                await bot.send_message(admin_id, notification, parse_mode=ParseMode.MARKDOWN)
+                refreshed += await refresh_channel_metrics(source_name)
             except Exception as e:
-                logger.error(f"Failed to send notification to admin {admin_id}: {e}")
+                logger.error(f"Error refreshing metrics of {source_name}: {e}")
+        
+        logger.info(f"Metrics refresh finished: {refreshed} posts in {time.monotonic() - started_at:.1f}s")
 
-async def collect_channel_content():
-    """Collect content from monitored sources"""
-    sources = get_sources()
+class CollectionScheduler:
+    """Polls every source on its own interval, adapted to how often the source posts"""
+    
+    def __init__(self, concurrency=COLLECTOR_CONCURRENCY):
+        self.concurrency = concurrency
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.queue = []  # Heap of (next_poll_at, source_name)
+        self.next_poll = {}  # source_name -> next_poll_at of its live heap entry
+        self.source_types = {}
+        self.running = set()
+        self.refreshed_at = 0
+        self.wakeup = asyncio.Event()
+        self.poll_all_requested = False  # poll_all_now() came before the sources were loaded
+        self.polls = 0  # Polls finished since the last refresh
+        self.poll_items = 0
+        self.poll_seconds = 0.0
+    
+    def schedule(self, source_name, next_poll_at):
+        """Put a source in the queue; older entries for it become stale"""
+        self.next_poll[source_name] = next_poll_at
+        heapq.heappush(self.queue, (next_poll_at, source_name))
+        self.wakeup.set()
+    
+    async def wait(self, timeout):
+        """Sleep until the timeout expires or a source gets scheduled"""
+        self.wakeup.clear()
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
     
-    conn = sqlite3.connect('telegram_content.db')
-    cursor = conn.cursor()
+    async def refresh_sources(self):
+        """Pick up sources that were added or removed since the last refresh"""
+        sources = await db.read(get_source_schedules)
+        now = time.time()
+        
+        self.source_types = {name: type_ for name, type_, _ in sources}
+        for name, _, next_poll_at in sources:
+            if name not in self.next_poll and name not in self.running:
+                self.schedule(name, now if self.poll_all_requested else next_poll_at or now)
+        self.poll_all_requested = False
+        
+        for name in list(self.next_poll):
+            if name not in self.source_types:
+                del self.next_poll[name]
+        
+        # Poll wall time shows whether the concurrency keeps up with the watchlist
+        if self.polls:
+            logger.info(f"Scheduler: {self.polls} polls, {self.poll_items} new items, "
+                        f"{self.poll_seconds / self.polls:.1f}s per poll over the last "
+                        f"{now - self.refreshed_at:.0f}s (concurrency {self.concurrency})")
+            self.polls, self.poll_items, self.poll_seconds = 0, 0, 0.0
+        
+        self.refreshed_at = now
+        logger.info(f"Scheduler: {len(self.source_types)} sources, {len(self.running)} running, "
+                    f"user cache {user_cache.stats()}, {db.pending_writes()} pending writes, "
+                    f"media {media_pipeline.stats()}, notifications {notification_dispatcher.stats()}, "
+                    f"accounts {account_pool.stats()}")
+    
+    async def run(self):
+        """Run due sources forever, most overdue first"""
+        while True:
+            now = time.time()
+            if now - self.refreshed_at >= SCHEDULER_REFRESH_INTERVAL:
+                await self.refresh_sources()
+            
+            if not self.queue:
+                await self.wait(SCHEDULER_REFRESH_INTERVAL)
+                continue
+            
+            next_poll_at, source_name = self.queue[0]
+            if self.next_poll.get(source_name) != next_poll_at:
+                heapq.heappop(self.queue)  # Stale entry of a removed or rescheduled source
+                continue
+            
+            if next_poll_at > now:
+                await self.wait(min(next_poll_at - now, SCHEDULER_REFRESH_INTERVAL))
+                continue
+            
+            await self.semaphore.acquire()
+            if self.queue[0] != (next_poll_at, source_name):
+                # A finished poll rescheduled something earlier while we waited for a free slot
+                self.semaphore.release()
+                continue
+            
+            heapq.heappop(self.queue)
+            del self.next_poll[source_name]
+            self.running.add(source_name)
+            asyncio.create_task(self.poll(source_name, self.source_types[source_name]))
     
-    for source_name, source_type in sources:
+    async def poll(self, source_name, source_type):
+        """Collect one source and schedule its next poll"""
         try:
-            # Join the channel/group if not joined already
-            try:
-                entity = await client.get_entity(source_name)
-                if hasattr(entity, 'megagroup') or hasattr(entity, 'channel'):
-                    await client(JoinChannelRequest(entity))
-            except ChannelPrivateError:
-                logger.error(f"Cannot join private channel/group: {source_name}")
+            polled_at = time.time()
+            new_items = await collect_source(source_name, source_type)
+            self.polls += 1
+            self.poll_items += new_items
+            self.poll_seconds += time.time() - polled_at
+            
+            # Sources covered by live updates are only polled to fill gaps
+            min_interval = RECONCILE_INTERVAL if live_ingestion.is_watching(source_name) else 0
+            next_poll_at = await db.write(update_source_schedule, source_name, new_items, polled_at, min_interval)
+            logger.info(f"Polled {source_name}: {new_items} new items, next poll in {next_poll_at - time.time():.0f}s")
+        except Exception as e:
+            logger.error(f"Scheduled collection of {source_name} failed: {e}")
+            next_poll_at = time.time() + DEFAULT_POLL_INTERVAL
+        finally:
+            self.semaphore.release()
+            self.running.discard(source_name)
+        
+        if source_name in self.source_types:
+            self.schedule(source_name, next_poll_at)
+
+    def poll_all_now(self):
+        """Make every source due immediately"""
+        now = time.time()
+        if not self.source_types:
+            self.poll_all_requested = True
+        for name in self.source_types:
+            if name not in self.running:
+                self.schedule(name, now)
+
+collection_scheduler = CollectionScheduler()
+
+class LiveIngestion:
+    """Stores messages of monitored sources as soon as Telegram pushes them"""
+    
+    def __init__(self):
+        self.sources = {}  # peer id -> (source_name, source_type)
+        self.discussions = {}  # peer id of a linked discussion group -> channel_name
+        self.unwatched_discussions = set()  # Channels whose comments could not be watched and are polled instead
+        self.reading_comments = set()  # Channels with a comment read in progress
+        self.comments_pending = set()  # Channels that got comments while their read was in progress
+        self.watched_by = {}  # source_name -> session name of the account it was resolved with
+        self.reconciled = set()  # Sources polled without gaps since the last (re)connect
+        self.generation = 0  # Bumped on every reconnect
+    
+    def is_watching(self, source_name):
+        """Check whether live updates of a source, including its comments, are being handled"""
+        if source_name in self.unwatched_discussions:
+            return False
+        return any(name == source_name for name, _ in self.sources.values())
+    
+    def is_live_event(self, event):
+        """Filter for update events coming from monitored sources and their discussion groups"""
+        return event.chat_id in self.sources or event.chat_id in self.discussions
+    
+    def mark_reconciled(self, source_name, generation):
+        """Record that a poll started in the given connection generation caught up with a source"""
+        if generation == self.generation:
+            self.reconciled.add(source_name)
+    
+    async def handle_event(self, event):
+        """Store a new or edited message through the regular ingestion path"""
+        account = account_pool.for_client(event.client)
+        if event.chat_id in self.discussions:
+            await self.read_comments(self.discussions[event.chat_id], account)
+            if event.chat_id not in self.sources:
+                return  # Unless the group is monitored as a source too
+        
+        source_name, source_type = self.sources[event.chat_id]
+        
+        try:
+            user_id = getattr(event.message.from_id, 'user_id', None)
+            if source_type != "channel" and user_id:
+                await user_cache.resolve([user_id], account)
+            
+            batch = IngestBatch()
+            batch.add_message(source_name, source_type, event.message, account)
+            
+            # After a reconnect the cursor must stay put until polling has filled the gap
+            if source_name in self.reconciled:
+                batch.source_cursor = (source_name, event.message.id)
+            new_rows = await db.write(batch.commit)
+            media_pipeline.submit(batch.media)
+            
+            await alert_new_rows(new_rows)
+        except Exception as e:
+            logger.error(f"Error storing live message from {source_name}: {e}")
+    
+    async def read_comments(self, channel_name, account):
+        """Read new comments of a channel from its discussion group, once for a burst of comment events"""
+        if channel_name in self.reading_comments:
+            self.comments_pending.add(channel_name)
+            return
+        
+        self.reading_comments.add(channel_name)
+        try:
+            while True:
+                # Comments arriving during a read are picked up by one more read, not one per event
+                self.comments_pending.discard(channel_name)
+                peer = await get_source_peer(channel_name, account)
+                await collect_comments(account, channel_name, peer)
+                if channel_name not in self.comments_pending:
+                    break
+        except Exception as e:
+            logger.error(f"Error storing live comments of {channel_name}: {e}")
+        finally:
+            self.reading_comments.discard(channel_name)
+    
+    async def watch_discussion(self, channel_name, peer, account):
+        """Receive updates of a channel's linked discussion group; without one its comments stay polled"""
+        self.unwatched_discussions.add(channel_name)
+        for peer_id, name in list(self.discussions.items()):
+            if name == channel_name:
+                del self.discussions[peer_id]
+        
+        discussion = await get_discussion_group(account, channel_name, peer)
+        if discussion:
+            # Telegram only pushes messages of groups the account is a member of
+            entity = await call_telegram(account, "entity", account.client.get_entity, PeerChannel(discussion[0]))
+            if getattr(entity, 'left', True):
+                await call_telegram(account, "join", account.client, JoinChannelRequest(entity))
+            self.discussions[utils.get_peer_id(PeerChannel(discussion[0]))] = channel_name
+        self.unwatched_discussions.discard(channel_name)
+    
+    async def refresh_sources(self):
+        """Resolve peer ids of newly added or moved sources and forget removed ones"""
+        sources = dict(await db.read(get_sources))
+        
+        for peer_id, (name, _) in list(self.sources.items()):
+            if name not in sources:
+                del self.sources[peer_id]
+                self.watched_by.pop(name, None)
+                self.unwatched_discussions.discard(name)
+        for peer_id, name in list(self.discussions.items()):
+            if name not in sources:
+                del self.discussions[peer_id]
+        
+        for name, type_ in sources.items():
+            # A source moved to another account is joined by that account so its updates keep coming
+            account = account_pool.account_for(name)
+            if self.watched_by.get(name) == account.session_name:
                 continue
+            try:
+                peer = await get_source_peer(name, account)
+                self.sources[utils.get_peer_id(peer)] = (name, type_)
+                self.watched_by[name] = account.session_name
             except Exception as e:
-                logger.error(f"Error joining channel/group {source_name}: {e}")
+                logger.error(f"Cannot watch live updates of {name}: {e}")
                 continue
             
-            # Get recent messages
-            messages = await client(GetHistoryRequest(
-                peer=source_name,
-                limit=50,
-                offset_date=None,
-                offset_id=0,
-                max_id=0,
-                min_id=0,
-                add_offset=0,
-                hash=0
-            ))
-            
-            for message in messages.messages:
-                message_date = message.date.strftime("%Y-%m-%d %H:%M:%S")
-                message_content = message.message
-                
-                if not message_content:
-                    continue
-                
-                if source_type == "channel":
-                    # Add post to database
-                    cursor.execute(
-                        "INSERT INTO posts (date, channel_name, content, message_id) VALUES (?, ?, ?, ?)",
-                        (message_date, source_name, message_content, message.id)
-                    )
-                    conn.commit()
-                    
-                    # Check if post contains keywords
-                    await check_keywords_in_content(message_content, source_name, "post", message_date)
-                    
-                    # Get comments if available
-                    try:
-                        comments = await client.get_messages(
-                            entity=source_name,
-                            reply_to=message.id,
-                            limit=100
-                        )
-                        
-                        for comment in comments:
-                            if not comment.message:
-                                continue
-                                
-                            comment_date = comment.date.strftime("%Y-%m-%d %H:%M:%S")
-                            comment_text = comment.message
-                            user_id = comment.from_id.user_id if comment.from_id else None
-                            username = None
-                            
-                            if user_id:
-                                try:
-                                    user = await client.get_entity(user_id)
-                                    username = user.username or f"{user.first_name} {user.last_name if user.last_name else ''}"
-                                except:
-                                    pass
-                            
-                            sentiment = analyze_sentiment(comment_text)
-                            
-                            # Add comment to database
-                            cursor.execute(
-                                "INSERT INTO comments (date, channel_name, post_content, comment_text, user_id, username, sentiment) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                                (comment_date, source_name, message_content, comment_text, user_id, username, sentiment)
-                            )
-                            conn.commit()
-                            
-                            # Check if comment contains keywords
-                            await check_keywords_in_content(comment_text, source_name, "comment", comment_date)
-                    except Exception as e:
-                        logger.error(f"Error getting comments for {source_name}, message {message.id}: {e}")
-                else:  # Group
-                    # Determine media type
-                    media_type = None
-                    if message.media:
-                        if hasattr(message.media, 'photo'):
-                            media_type = "photo"
-                        elif hasattr(message.media, 'document'):
-                            if hasattr(message.media.document, 'mime_type'):
-                                if 'video' in message.media.document.mime_type:
-                                    media_type = "video"
-                                elif 'audio' in message.media.document.mime_type:
-                                    media_type = "audio"
-                                else:
-                                    media_type = "document"
-                    
-                    user_id = message.from_id.user_id if message.from_id else None
-                    username = None
-                    
-                    if user_id:
-                        try:
-                            user = await client.get_entity(user_id)
-                            username = user.username or f"{user.first_name} {user.last_name if user.last_name else ''}"
-                        except:
-                            pass
-                    
-                    # Add message to database
-                    cursor.execute(
-                        "INSERT INTO messages (date, source, content, user_id, username, media_type) VALUES (?, ?, ?, ?, ?, ?)",
-                        (message_date, source_name, message_content, user_id, username, media_type)
-                    )
-                    conn.commit()
-                    
-                    # Check if message contains keywords
-                    await check_keywords_in_content(message_content, source_name, "message", message_date)
-                    
+            if type_ == "channel":
+                try:
+                    await self.watch_discussion(name, peer, account)
+                except Exception as e:
+                    logger.error(f"Cannot watch live comments of {name}, they are polled instead: {e}")
+    
+    async def run(self):
+        """Register update handlers and reconcile sources after reconnects"""
+        for account in account_pool.accounts:
+            account.client.add_event_handler(self.handle_event, events.NewMessage(func=self.is_live_event))
+            account.client.add_event_handler(self.handle_event, events.MessageEdited(func=self.is_live_event))
+        was_connected = {account.session_name: account.client.is_connected() for account in account_pool.accounts}
+        
+        # Messages posted while the bot was down are a gap just like those missed during a disconnect
+        try:
+            await self.refresh_sources()
         except Exception as e:
-            logger.error(f"Error collecting content from {source_name}: {e}")
-    
-    conn.close()
+            logger.error(f"Error refreshing live sources: {e}")
+        logger.info("Live ingestion started, reconciling all sources")
+        collection_scheduler.poll_all_now()
+        
+        while True:
+            try:
+                await self.refresh_sources()
+            except Exception as e:
+                logger.error(f"Error refreshing live sources: {e}")
+            
+            connected = {account.session_name: account.client.is_connected() for account in account_pool.accounts}
+            if any(connected[name] and not was_connected[name] for name in connected):
+                logger.info("Connection to Telegram restored, reconciling all sources")
+                self.generation += 1
+                self.reconciled.clear()
+                collection_scheduler.poll_all_now()
+            was_connected = connected
+            
+            await asyncio.sleep(LIVE_CHECK_INTERVAL)
+
+live_ingestion = LiveIngestion()
+
+class SearchSession:
+    """A search shown to an admin: the query, the period and the cursors of the pages visited"""
+    
+    def __init__(self, query, start_date, end_date):
+        self.query = query
+        self.start_date = start_date
+        self.end_date = end_date
+        self.total = None
+        self.page = 0
+        self.cursors = [None]  # page -> cursor of the last row before it
+        self.next_cursor = None
+        self.fuzzy = False  # Ranked by trigram similarity instead of matching exact words
+        self.truncated = False  # Fuzzy candidates hit FUZZY_CANDIDATES, so older matches were not checked
+
+class SearchSessions:
+    """Recent searches by id, so the buttons of a results message can fetch other pages"""
+    
+    def __init__(self, capacity=SEARCH_SESSIONS):
+        self.capacity = capacity
+        self.sessions = OrderedDict()
+        self.last_id = int(time.time())  # Buttons left from an earlier run never point at a new search
+    
+    def add(self, session):
+        """Remember a search, forgetting the oldest ones. Returns its id"""
+        self.last_id += 1
+        self.sessions[self.last_id] = session
+        while len(self.sessions) > self.capacity:
+            self.sessions.popitem(last=False)
+        return self.last_id
+    
+    def get(self, session_id):
+        """Get a search by id, or None once it has been forgotten"""
+        session = self.sessions.get(session_id)
+        if session:
+            self.sessions.move_to_end(session_id)
+        return session
+
+search_sessions = SearchSessions()
+
+class SearchCache:
+    """LRU cache of search pages and counts; ingestion bumps a generation that drops entries covering its rows"""
+    
+    def __init__(self, max_bytes=SEARCH_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # (function, query, start_date, end_date, *args) -> (value, size)
+        self.size = 0
+        self.generation = 0
+        self.writes = deque(maxlen=SEARCH_CACHE_WRITE_LOG)  # (generation, first date, last date)
+        self.lock = threading.Lock()  # bump() is called on the database writer thread
+        self.hits = 0
+        self.misses = 0
+        self.invalidated = 0
+    
+    def get(self, key):
+        """Get a cached value, or None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+    
+    def put(self, key, value, generation):
+        """Cache a value read at the given generation, unless rows were written into its period since"""
+        size = sys.getsizeof(key) + estimate_size(value)
+        with self.lock:
+            if generation < self.generation:
+                if not self.writes or self.writes[0][0] > generation + 1:
+                    return
+                if any(write_generation > generation and overlaps(key, first_date, last_date)
+                       for write_generation, first_date, last_date in self.writes):
+                    return
+            
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                self.size -= self.entries.popitem(last=False)[1][1]
+    
+    def bump(self, first_date, last_date):
+        """Record rows written between two dates, dropping cached searches whose period includes them"""
+        with self.lock:
+            self.generation += 1
+            self.writes.append((self.generation, first_date, last_date))
+            for key in [key for key in self.entries if overlaps(key, first_date, last_date)]:
+                self.size -= self.entries.pop(key)[1]
+                self.invalidated += 1
+    
+    def stats(self):
+        """Get hit/miss counters"""
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidated": self.invalidated,
+            "hit_ratio": self.hits / lookups if lookups else 0,
+        }
+
+def overlaps(key, first_date, last_date):
+    """Check if rows dated between first_date and last_date fall into the period of a search cache key"""
+    _, _, start_date, end_date = key[:4]
+    return first_date[:10] <= end_date and last_date[:10] >= start_date
+
+def estimate_size(value):
+    """Approximate the memory held by a cached search page or count"""
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(estimate_size(item) for item in value)
+    return sys.getsizeof(value)
+
+search_cache = SearchCache()
+
+async def cached_search(func, query, start_date, end_date, *args):
+    """Run a search function on a database reader, reusing the result of an identical earlier search"""
+    # FTS5 ignores case, so queries that differ only in case or spacing share an entry
+    key = (func.__name__, (build_match_query(query) or "").lower(), start_date, end_date, *args)
+    value = search_cache.get(key)
+    if value is None:
+        generation = search_cache.generation
+        value = await db.read(func, query, start_date, end_date, *args)
+        search_cache.put(key, value, generation)
+    return value
 
 # Command handlers
 @dp.message_handler(commands=['start', 'help'])
@@ -755,6 +3298,15 @@ async def send_welcome(message: types.Message):
     
     await message.answer(welcome_message, reply_markup=keyboard)
 
+@dp.message_handler(commands=['rescore_sentiment'])
+async def rescore_sentiment_command(message: types.Message):
+    """Re-score stored comments after the sentiment lexicon has changed"""
+    if rescore_lock.locked():
+        await message.answer("⏳ Пересчёт тональности уже выполняется, дождитесь его завершения.")
+        return
+    
+    asyncio.create_task(run_sentiment_rescore(message.from_user.id))
+
 @dp.message_handler(lambda message: message.text == "📤 Экспорт данных")
 async def export_data_command(message: types.Message):
     """Start export data flow"""
@@ -863,7 +3415,7 @@ async def process_export_format(callback_query: types.CallbackQuery, state: FSMC
     
     try:
         if export_format == "excel":
-            filename = export_data_to_excel(data_type, start_date, end_date)
+            filename = await db.read(export_data_to_excel, data_type, start_date, end_date)
             
             with open(filename, 'rb') as file:
                 await bot.send_document(
@@ -872,7 +3424,7 @@ async def process_export_format(callback_query: types.CallbackQuery, state: FSMC
                     caption=f"Экспорт данных ({data_type}) с {start_date} по {end_date}"
                 )
         else:  # JSON
-            filename = export_data_to_json(data_type, start_date, end_date)
+            filename = await db.read(export_data_to_json, data_type, start_date, end_date)
             
             with open(filename, 'rb') as file:
                 await bot.send_document(
@@ -1006,9 +3558,10 @@ async def process_source_type(callback_query: types.CallbackQuery, state: FSMCon
     data = await state.get_data()
     source_name = data.get('source_name')
     
-    result = add_source(source_name, source_type)
+    result = await db.write(add_source, source_name, source_type)
     
     if result:
+        await start_backfill(source_name, source_type)
         await callback_query.message.edit_text(f"✅ Источник '{source_name}' успешно добавлен!")
     else:
         await callback_query.message.edit_text(f"❌ Источник '{source_name}' уже существует или произошла ошибка.")
@@ -1030,7 +3583,7 @@ async def list_sources_command(callback_query: types.CallbackQuery):
     """List all monitored sources"""
     await callback_query.answer()
     
-    sources = get_sources()
+    sources = await db.read(get_sources)
     
     if not sources:
         await callback_query.message.edit_text(
@@ -1058,7 +3611,7 @@ async def delete_source_command(callback_query: types.CallbackQuery):
     """Start delete source flow"""
     await callback_query.answer()
     
-    sources = get_sources()
+    sources = await db.read(get_sources)
     
     if not sources:
         await callback_query.message.edit_text(
@@ -1106,7 +3659,8 @@ async def process_delete_confirmation(callback_query: types.CallbackQuery, state
     source_name = data.get('source_name')
     
     if callback_query.data == "confirm_delete_yes":
-        delete_source(source_name)
+        await db.write(delete_source, source_name)
+        await invalidate_source_peer(source_name)
         await callback_query.message.edit_text(f"✅ Источник '{source_name}' удален.")
     else:
         await callback_query.message.edit_text("❌ Удаление отменено.")
@@ -1144,6 +3698,7 @@ async def manage_keywords_command(message: types.Message):
     keyboard.add(InlineKeyboardButton("➕ Добавить ключевое слово", callback_data="add_keyword"))
     keyboard.add(InlineKeyboardButton("📃 Список ключевых слов", callback_data="list_keywords"))
     keyboard.add(InlineKeyboardButton("❌ Удалить ключевое слово", callback_data="delete_keyword"))
+    keyboard.add(InlineKeyboardButton("🔎 Проверить историю", callback_data="scan_all_keywords"))
     keyboard.add(InlineKeyboardButton("« Назад", callback_data="back_to_main"))
     
     await message.answer("Управление ключевыми словами:", reply_markup=keyboard)
@@ -1163,10 +3718,17 @@ async def process_keyword(message: types.Message, state: FSMContext):
     """Process keyword input"""
     keyword = message.text.strip().lower()
     
-    result = add_keyword(keyword)
+    keyword_id = await db.write(add_keyword, keyword)
+    keyword_index.invalidate()
     
-    if result:
-        await message.answer(f"✅ Ключевое слово '{keyword}' успешно добавлено!")
+    if keyword_id:
+        # callback_data is limited to 64 bytes, so the button carries the id rather than the word
+        await message.answer(
+            f"✅ Ключевое слово '{keyword}' успешно добавлено!",
+            reply_markup=InlineKeyboardMarkup().add(
+                InlineKeyboardButton("🔎 Найти в собранных данных", callback_data=f"scan_kw_{keyword_id}")
+            )
+        )
     else:
         await message.answer(f"❌ Ключевое слово '{keyword}' уже существует или произошла ошибка.")
     
@@ -1177,6 +3739,7 @@ async def process_keyword(message: types.Message, state: FSMContext):
     keyboard.add(InlineKeyboardButton("➕ Добавить ключевое слово", callback_data="add_keyword"))
     keyboard.add(InlineKeyboardButton("📃 Список ключевых слов", callback_data="list_keywords"))
     keyboard.add(InlineKeyboardButton("❌ Удалить ключевое слово", callback_data="delete_keyword"))
+    keyboard.add(InlineKeyboardButton("🔎 Проверить историю", callback_data="scan_all_keywords"))
     keyboard.add(InlineKeyboardButton("« Назад", callback_data="back_to_main"))
     
     await message.answer("Управление ключевыми словами:", reply_markup=keyboard)
@@ -1186,7 +3749,7 @@ async def list_keywords_command(callback_query: types.CallbackQuery):
     """List all monitored keywords"""
     await callback_query.answer()
     
-    keywords = get_keywords()
+    keywords = await db.read(get_keywords)
     
     if not keywords:
         await callback_query.message.edit_text(
@@ -1213,7 +3776,7 @@ async def delete_keyword_command(callback_query: types.CallbackQuery):
     """Start delete keyword flow"""
     await callback_query.answer()
     
-    keywords = get_keywords()
+    keywords = await db.read(get_keywords)
     
     if not keywords:
         await callback_query.message.edit_text(
@@ -1261,7 +3824,8 @@ async def process_delete_keyword_confirmation(callback_query: types.CallbackQuer
     keyword = data.get('keyword')
     
     if callback_query.data == "confirm_kw_delete_yes":
-        delete_keyword(keyword)
+        await db.write(delete_keyword, keyword)
+        keyword_index.invalidate()
         await callback_query.message.edit_text(f"✅ Ключевое слово '{keyword}' удалено.")
     else:
         await callback_query.message.edit_text("❌ Удаление отменено.")
@@ -1274,10 +3838,35 @@ async def process_delete_keyword_confirmation(callback_query: types.CallbackQuer
     keyboard.add(InlineKeyboardButton("➕ Добавить ключевое слово", callback_data="add_keyword"))
     keyboard.add(InlineKeyboardButton("📃 Список ключевых слов", callback_data="list_keywords"))
     keyboard.add(InlineKeyboardButton("❌ Удалить ключевое слово", callback_data="delete_keyword"))
+    keyboard.add(InlineKeyboardButton("🔎 Проверить историю", callback_data="scan_all_keywords"))
     keyboard.add(InlineKeyboardButton("« Назад", callback_data="back_to_main"))
     
     await callback_query.message.edit_text("Управление ключевыми словами:", reply_markup=keyboard)
 
+@dp.callback_query_handler(lambda c: c.data == "scan_all_keywords" or c.data.startswith('scan_kw_'))
+async def scan_keywords_command(callback_query: types.CallbackQuery):
+    """Scan stored content for one keyword or the whole keyword list"""
+    await callback_query.answer()
+    
+    if callback_query.data == "scan_all_keywords":
+        keywords = await db.read(get_keywords)
+    else:
+        keyword = await db.read(get_keyword, int(callback_query.data[8:]))  # Remove 'scan_kw_' prefix
+        if keyword is None:
+            await callback_query.message.answer("❌ Это ключевое слово уже удалено.")
+            return
+        keywords = [keyword]
+    
+    if not keywords:
+        await callback_query.message.answer("🔑 Список ключевых слов пуст.")
+        return
+    
+    if scan_lock.locked():
+        await callback_query.message.answer("⏳ Проверка истории уже выполняется, дождитесь её завершения.")
+        return
+    
+    asyncio.create_task(run_keyword_scan(keywords, callback_query.from_user.id))
+
 @dp.callback_query_handler(lambda c: c.data == "back_to_keywords")
 async def back_to_keywords_menu(callback_query: types.CallbackQuery):
     """Return to keywords management"""
@@ -1287,6 +3876,7 @@ async def back_to_keywords_menu(callback_query: types.CallbackQuery):
     keyboard.add(InlineKeyboardButton("➕ Добавить ключевое слово", callback_data="add_keyword"))
     keyboard.add(InlineKeyboardButton("📃 Список ключевых слов", callback_data="list_keywords"))
     keyboard.add(InlineKeyboardButton("❌ Удалить ключевое слово", callback_data="delete_keyword"))
+    keyboard.add(InlineKeyboardButton("🔎 Проверить историю", callback_data="scan_all_keywords"))
     keyboard.add(InlineKeyboardButton("« Назад", callback_data="back_to_main"))
     
     await callback_query.message.edit_text("Управление ключевыми словами:", reply_markup=keyboard)
@@ -1339,29 +3929,146 @@ async def process_search_period(callback_query: types.CallbackQuery, state: FSMC
         
         await callback_query.message.edit_text("🔍 Выполняется поиск, пожалуйста, подождите...")
         
-        # Perform search
-        results = search_content(query, start_date, end_date)
+        session_id = search_sessions.add(SearchSession(query, start_date, end_date))
+        await show_search_page(callback_query.message, session_id)
         
-        if not results:
-            await callback_query.message.edit_text(
-                f"❌ По запросу '{query}' ничего не найдено.",
-                reply_markup=InlineKeyboardMarkup().add(
-                    InlineKeyboardButton("🔙 Новый поиск", callback_data="new_search")
-                )
-            )
-        else:
-            # Format results
-            result_text = f"🔍 Результаты поиска по запросу '{query}':\n\n"
-            
-            for i, (date, source, content, content_type) in enumerate(results[:15], 1):  # Limit to 15 results
-                formatted_date = date.split()[0] if ' ' in date else date
-                result_text += f"{i}. [{formatted_date}] {source} ({content_type}):\n{content[:100]}...\n\n"
-            
-            if len(results) > 15:
-                result_text += f"\nПоказаны первые 15 из {len(results)} результатов."
-            
-            # Split message if it's too long
-            if len(result_text) > 4000:
-                chunks = [result_text[i:i+4000] for i in range(0, len(result_text), 4000)]
-                for chunk in chunks:
-                    await bot.send_message(callback_query.from_user.id, chunk
+        await state.finish()
+
+@dp.callback_query_handler(lambda c: c.data.startswith('search_page_'))
+async def process_search_page(callback_query: types.CallbackQuery):
+    """Show the next or previous page of a search"""
+    await callback_query.answer()
+    
+    _, _, session_id, direction = callback_query.data.split('_')
+    session = search_sessions.get(int(session_id))
+    if not session:
+        await callback_query.message.edit_text("⌛ Результаты поиска устарели, выполните поиск заново.")
+        return
+    
+    if direction == "next" and session.next_cursor:
+        session.cursors = session.cursors[:session.page + 1] + [session.next_cursor]
+        session.page += 1
+    elif direction == "prev" and session.page > 0:
+        session.page -= 1
+    
+    await show_search_page(callback_query.message, int(session_id))
+
+@dp.callback_query_handler(lambda c: c.data.startswith('search_fuzzy_'))
+async def process_fuzzy_search(callback_query: types.CallbackQuery):
+    """Repeat a search tolerating typos, substrings and the other alphabet"""
+    await callback_query.answer()
+    
+    session_id = int(callback_query.data[13:])  # Remove 'search_fuzzy_' prefix
+    session = search_sessions.get(session_id)
+    if not session:
+        await callback_query.message.edit_text("⌛ Результаты поиска устарели, выполните поиск заново.")
+        return
+    
+    session.fuzzy = True
+    session.total = None
+    session.page = 0
+    session.cursors = [None]
+    
+    await callback_query.message.edit_text("🔍 Выполняется нечёткий поиск, пожалуйста, подождите...")
+    await show_search_page(callback_query.message, session_id)
+
+async def read_fuzzy_page(session):
+    """Get the rows of the current fuzzy search page, the cursor of the next one and the number of matches"""
+    matches, session.truncated = await cached_search(fuzzy_search_matches, session.query,
+                                                     session.start_date, session.end_date)
+    if session.total is None:
+        logger.info(f"Fuzzy search for '{session.query}': {len(matches)} matches"
+                    f"{' (candidates capped)' if session.truncated else ''}, cache {search_cache.stats()}")
+    
+    # Matches are sorted best first, so the next page holds the ones ranked below the cursor
+    after = session.cursors[session.page]
+    remaining = [match for match in matches if after is None or match < after]
+    page = remaining[:SEARCH_PAGE_SIZE]
+    
+    rows = await db.read(get_search_rows, page)
+    next_cursor = page[-1] if len(remaining) > SEARCH_PAGE_SIZE else None
+    return rows, next_cursor, len(matches)
+
+async def show_search_page(message, session_id):
+    """Fetch the current page of a search and show it with navigation buttons"""
+    session = search_sessions.get(session_id)
+    
+    # The total is counted once per search; paging only reads the rows it shows
+    if session.fuzzy:
+        rows, session.next_cursor, session.total = await read_fuzzy_page(session)
+    elif session.total is None:
+        (rows, session.next_cursor), session.total = await asyncio.gather(
+            cached_search(search_content, session.query, session.start_date, session.end_date,
+                          session.cursors[session.page]),
+            cached_search(count_search_results, session.query, session.start_date, session.end_date)
+        )
+        logger.info(f"Search for '{session.query}': {session.total} matches, cache {search_cache.stats()}")
+    else:
+        rows, session.next_cursor = await cached_search(
+            search_content, session.query, session.start_date, session.end_date, session.cursors[session.page]
+        )
+    
+    # Offered when exact words may miss typos, substrings and transliterated spellings
+    fuzzy_button = None
+    if TRIGRAM_SEARCH_AVAILABLE and not session.fuzzy:
+        fuzzy_button = InlineKeyboardButton("🔤 Нечёткий поиск", callback_data=f"search_fuzzy_{session_id}")
+    
+    if not rows:
+        keyboard = InlineKeyboardMarkup()
+        if fuzzy_button:
+            keyboard.add(fuzzy_button)
+        keyboard.add(InlineKeyboardButton("🔙 Новый поиск", callback_data="new_search"))
+        await message.edit_text(f"❌ По запросу '{session.query}' ничего не найдено.", reply_markup=keyboard)
+        return
+    
+    # Format results
+    first = session.page * SEARCH_PAGE_SIZE
+    mode = "нечёткого поиска" if session.fuzzy else "поиска"
+    total = f"не менее {session.total}" if session.fuzzy and session.truncated else session.total
+    result_text = (
+        f"🔍 Результаты {mode} по запросу '{session.query}' "
+        f"({first + 1}–{first + len(rows)} из {total}):\n\n"
+    )
+    if session.fuzzy and session.truncated:
+        result_text += "⚠️ Слишком много похожих записей, проверены только самые новые. Уточните запрос или период.\n\n"
+    for i, (date, source, content, content_type) in enumerate(rows, first + 1):
+        formatted_date = date.split()[0] if ' ' in date else date
+        result_text += f"{i}. [{formatted_date}] {source} ({content_type}):\n{(content or '')[:100]}...\n\n"
+    
+    buttons = []
+    if session.page > 0:
+        buttons.append(InlineKeyboardButton("« Назад", callback_data=f"search_page_{session_id}_prev"))
+    if session.next_cursor:
+        buttons.append(InlineKeyboardButton("Вперёд »", callback_data=f"search_page_{session_id}_next"))
+    
+    keyboard = InlineKeyboardMarkup().add(*buttons)
+    if fuzzy_button:
+        keyboard.add(fuzzy_button)
+    await message.edit_text(result_text, reply_markup=keyboard)
+
+async def on_startup(dispatcher):
+    """Connect the Telethon clients and start scheduled collection"""
+    global sentiment_analyzer
+    sentiment_analyzer = SentimentAnalyzer.load()
+    db.start()
+    notification_dispatcher.start()
+    await db.write(init_db)
+    for account in account_pool.accounts:
+        try:
+            await account.start()
+        except BANNED_ACCOUNT_ERRORS as e:
+            logger.error(f"Account {account.session_name} cannot log in ({e}), its sources go to other accounts")
+            account.banned = True
+    asyncio.create_task(collection_scheduler.run())
+    if INGESTION_MODE == "push":
+        asyncio.create_task(live_ingestion.run())
+    asyncio.create_task(run_metrics_refresh())
+    if MEDIA_DOWNLOAD_ENABLED:
+        media_pipeline.start()
+    
+    # Continue backfills interrupted by a restart
+    for source_name, source_type in await db.read(get_pending_backfills):
+        await start_backfill(source_name, source_type)
+
+if __name__ == '__main__':
+    executor.start_polling(dp, skip_updates=True, on_startup=on_startup)
@@ -0,0 +1,221 @@
+import hashlib
+import json
+import logging
+import os
+
+# Text analysis shared by the bot and its scan and re-score worker processes. Workers are spawned and import
+# this module instead of telegram_bot, so it must stay free of side effects: no bot, clients, threads or files
+logger = logging.getLogger(__name__)
+
+# Optional sentiment lexicon: one "word<TAB>weight" per line, a trailing * marks a stem that matches any ending
+SENTIMENT_LEXICON_PATH = 'sentiment_lexicon.tsv'
+
+# Lexicon used when no file is present
+DEFAULT_SENTIMENT_LEXICON = {
+    "хорош*": 1, "отличн*": 1, "супер": 1, "класс*": 1,
+    "радост*": 1, "счаст*": 1, "великолепн*": 1, "прекрасн*": 1,
+    "плох*": -1, "ужасн*": -1, "отстой*": -1, "проблем*": -1,
+    "неудач*": -1, "грустн*": -1, "разочарован*": -1, "жаль": -1,
+}
+
+# Words that flip the sentiment of the next few words
+NEGATION_WORDS = {"не", "нет", "ни", "без", "not", "no", "never"}
+NEGATION_WINDOW = 3
+
+# Bumped whenever the scoring code changes, so labels produced by the old code get re-scored
+SENTIMENT_RULES_REVISION = 3
+
+# Distinct words whose weight is remembered before the memo is reset
+SENTIMENT_CACHE_SIZE = 200000
+
+# Stripped from both ends of whitespace-separated tokens before the lexicon lookup
+TOKEN_PUNCTUATION = "!\"#$%&'()*+,-./:;<=>?@[\\]^_`{|}~«»—–…“”„"
+
+# Punctuation at the end of a token that closes a clause, and with it the scope of a negation
+CLAUSE_PUNCTUATION = ",.!?;:…"
+
+class TokenWeights(dict):
+    """Memo of token weights keyed by raw tokens; unknown tokens are stripped and looked up in the lexicon once"""
+    
+    def __init__(self, analyzer):
+        super().__init__()
+        self.analyzer = analyzer
+        self.negations = set()  # Raw tokens that are negation words once stripped, such as "нет!"
+    
+    def __missing__(self, token):
+        word = token.strip(TOKEN_PUNCTUATION)
+        if word in NEGATION_WORDS:
+            self.negations.add(token)
+        weight = self.analyzer.weight(word)
+        self[token] = weight
+        return weight
+
+class SentimentAnalyzer:
+    """Lexicon-based sentiment scoring with word boundaries and negation"""
+    
+    def __init__(self, lexicon):
+        self.lexicon = dict(lexicon)
+        self.words = {}  # whole word -> weight
+        self.stems = {}  # stem -> weight, matches words starting with it
+        for entry, weight in lexicon.items():
+            entry = entry.lower()
+            if entry.endswith("*"):
+                self.stems[entry[:-1]] = weight
+            else:
+                self.words[entry] = weight
+        self.stem_lengths = sorted({len(stem) for stem in self.stems}, reverse=True)
+        self.token_weights = TokenWeights(self)
+        
+        # Labels from a different version were scored by different rules and get re-scored
+        rules = json.dumps([sorted(self.lexicon.items()), sorted(NEGATION_WORDS), NEGATION_WINDOW, SENTIMENT_RULES_REVISION],
+                           ensure_ascii=False)
+        self.version = hashlib.sha256(rules.encode('utf-8')).hexdigest()[:12]
+    
+    @classmethod
+    def load(cls, path=SENTIMENT_LEXICON_PATH):
+        """Read a lexicon file, falling back to the built-in lexicon when there is none"""
+        if not os.path.exists(path):
+            return cls(DEFAULT_SENTIMENT_LEXICON)
+        
+        lexicon = {}
+        with open(path, encoding='utf-8') as file:
+            for line_number, line in enumerate(file, 1):
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                word, _, weight = line.partition("\t")
+                try:
+                    lexicon[word.strip()] = float(weight) if weight else 1
+                except ValueError:
+                    logger.warning(f"Skipping line {line_number} of {path}: weight {weight!r} is not a number")
+        
+        logger.info(f"Sentiment lexicon loaded from {path}: {len(lexicon)} entries")
+        return cls(lexicon)
+    
+    def weight(self, token):
+        """Get the weight of a token stripped of punctuation; the cost depends on its length, not on the lexicon size"""
+        # Whole tokens only, so "класс" is not found inside "одноклассник"
+        weight = self.words.get(token)
+        if weight is not None:
+            return weight
+        for length in self.stem_lengths:
+            if length <= len(token):
+                weight = self.stems.get(token[:length])
+                if weight is not None:
+                    return weight
+        return 0
+    
+    def score(self, text):
+        """Get the summed weight of a text; negation flips the words that follow it"""
+        # Raw tokens go to the memo, so punctuation is stripped once per distinct token, not once per occurrence
+        weights = self.token_weights
+        tokens = text.lower().split()
+        total = sum(map(weights.__getitem__, tokens))
+        negations = weights.negations
+        if negations.isdisjoint(tokens):
+            return total
+        
+        # Only the few tokens after each negation need a second look; a later negation starts its own scope
+        positions = [position for position, token in enumerate(tokens) if token in negations]
+        for position, next_position in zip(positions, positions[1:] + [len(tokens)]):
+            negation = tokens[position]
+            total -= weights[negation]
+            
+            # A negation that ends its clause ("Не, это отлично") flips nothing after it
+            if negation[-1] in CLAUSE_PUNCTUATION:
+                continue
+            for token in tokens[position + 1:min(position + 1 + NEGATION_WINDOW, next_position)]:
+                total -= 2 * weights[token]
+                if token[-1] in CLAUSE_PUNCTUATION:
+                    break
+        return total
+    
+    def classify(self, texts):
+        """Label a batch of texts as positive, negative or neutral"""
+        if len(self.token_weights) > SENTIMENT_CACHE_SIZE:
+            self.token_weights.clear()
+        
+        labels = []
+        for text in texts:
+            score = self.score(text) if text else 0
+            if score > 0:
+                labels.append("positive")
+            elif score < 0:
+                labels.append("negative")
+            else:
+                labels.append("neutral")
+        return labels
+
+class KeywordMatcher:
+    """Aho-Corasick automaton that finds every keyword in a text in a single pass"""
+    
+    def __init__(self, keywords):
+        self.keywords = list(keywords)
+        self.transitions = [{}]  # state -> {character: next state}
+        self.fail = [0]
+        self.outputs = [set()]  # state -> indexes of keywords ending here
+        
+        for index, keyword in enumerate(self.keywords):
+            state = 0
+            for char in keyword.lower():
+                next_state = self.transitions[state].get(char)
+                if next_state is None:
+                    next_state = len(self.transitions)
+                    self.transitions[state][char] = next_state
+                    self.transitions.append({})
+                    self.fail.append(0)
+                    self.outputs.append(set())
+                state = next_state
+            self.outputs[state].add(index)
+        
+        # Breadth-first, so the fail link of every shallower state is ready before it is needed
+        queue = list(self.transitions[0].values())
+        for state in queue:
+            for char, next_state in self.transitions[state].items():
+                fallback = self.fail[state]
+                while fallback and char not in self.transitions[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.transitions[fallback].get(char, 0)
+                self.outputs[next_state] |= self.outputs[self.fail[next_state]]
+                queue.append(next_state)
+    
+    def find(self, text):
+        """Get the keywords contained in a text, case-insensitive, in the order of the keyword list"""
+        found = set()
+        state = 0
+        for char in text.lower():
+            while state and char not in self.transitions[state]:
+                state = self.fail[state]
+            state = self.transitions[state].get(char, 0)
+            found |= self.outputs[state]
+        return [self.keywords[index] for index in sorted(found)]
+
+# Matcher of a keyword scan worker process, compiled once per process
+scan_matcher = None
+
+def init_scan_worker(keywords):
+    """Compile the scanned keywords in a freshly started worker process"""
+    global scan_matcher
+    scan_matcher = KeywordMatcher(keywords)
+
+def scan_rows(content_type, rows):
+    """Match a chunk of (id, source, date, text) rows in a worker process. Returns the hits"""
+    hits = []
+    for row_id, source, date, text in rows:
+        if text:
+            for keyword in scan_matcher.find(text):
+                hits.append((keyword, content_type, row_id, source, date))
+    return hits
+
+# Analyzer of a sentiment re-score worker process, built once per process
+rescore_analyzer = None
+
+def init_sentiment_worker(lexicon):
+    """Build the analyzer of a re-score worker process from the lexicon the bot is using"""
+    global rescore_analyzer
+    rescore_analyzer = SentimentAnalyzer(lexicon)
+
+def rescore_rows(rows):
+    """Label a chunk of (id, comment_text) rows in a worker process. Returns (sentiment, id) pairs"""
+    labels = rescore_analyzer.classify([text for _, text in rows])
+    return [(label, row[0]) for label, row in zip(labels, rows)]